@@ -0,0 +1,415 @@
+# -*- coding: utf-8 -*-
+"""Purr.Archiver copies, moves, packs and removes data products, for archiving them in a purrlog
+(and restoring them from it).
+
+Everything is done in-process. File data is copied with os.copy_file_range() where available (which lets
+the kernel, or the filesystem, do the copy without passing the data through user space), else with
+os.sendfile(), and else with plain reads and writes. Moves are done by renaming when source and destination
+are on the same device. Progress of long copies is reported through Purr.progressMessage().
+
+archiveFile() can also make cheaper "copies": a reflink (a copy-on-write clone, on filesystems such as btrfs
+and XFS that support them), or a hard link to a read-only file. It reports which method it ended up using,
+so that this can be recorded with the data product.
+
+Errors are raised as OSError (or IOError/tarfile.TarError) with the details of what went wrong; a failed copy
+does not leave a partial destination file behind.
+
+Directories that are moved within a device can be packed in the background: the directory is first renamed
+into a staging area next to its destination (which is instant, and frees up the source path), and the
+tarball is then made from the staging area by a worker thread. waitFor() waits for such pending work, and
+recoverStaged() finishes it if it was interrupted.
+"""
+
+import concurrent.futures
+import contextlib
+import errno
+import os
+import os.path
+import shutil
+import stat
+import tarfile
+import threading
+import time
+import traceback
+from typing import Dict
+
+# fcntl is needed for reflinks, which are only available on Linux anyway
+try:
+    import fcntl
+    HAVE_FCNTL = True
+except ImportError:
+    HAVE_FCNTL = False
+
+import Purr
+from Purr import dprintf
+
+# ioctl request for cloning a file, see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+# archive modes, as set per watch pattern. Each mode tries a cheaper method first, and falls back to the next.
+#   copy:    always make a real copy
+#   reflink: make a reflink if the filesystem supports it, else a copy
+#   link:    as reflink, but a read-only file may also be hard-linked
+ARCHIVE_MODES = ("copy", "reflink", "link")
+
+# size of chunks in which file data is copied
+CHUNK_SIZE = 64 * 1024 * 1024
+# minimum interval between progress messages, in seconds
+PROGRESS_INTERVAL = 0.5
+
+
+class _Progress(object):
+    """Reports byte-level progress of an operation through Purr.progressMessage(), at most once every
+    PROGRESS_INTERVAL seconds. Operations running in worker threads are not reported, since the GUI can
+    only be updated from the main thread."""
+
+    def __init__(self, label, total):
+        self.label = label
+        self.total = total
+        self.done = 0
+        self._next_report = time.time() + PROGRESS_INTERVAL
+
+    def update(self, nbytes):
+        self.done += nbytes
+        now = time.time()
+        if now >= self._next_report and threading.current_thread() is threading.main_thread():
+            self._next_report = now + PROGRESS_INTERVAL
+            if self.total:
+                Purr.progressMessage("%s: %d%% of %s" % (self.label, min(self.done * 100 // self.total, 100),
+                                                         formatSize(self.total)), sub=True)
+            else:
+                Purr.progressMessage("%s: %s" % (self.label, formatSize(self.done)), sub=True)
+
+
+class DeviceLimiter(object):
+    """Limits the number of archiving operations (streams) running concurrently on any one device, for when
+    data products are archived in parallel. A limit of 0 means no limit."""
+
+    def __init__(self, maxstreams):
+        self.maxstreams = maxstreams
+        self._lock = threading.Lock()
+        # dict of device number: semaphore
+        self._semaphores = {}
+
+    def _semaphore(self, dev):
+        with self._lock:
+            sem = self._semaphores.get(dev)
+            if sem is None:
+                sem = self._semaphores[dev] = threading.Semaphore(self.maxstreams)
+            return sem
+
+    @contextlib.contextmanager
+    def streams(self, *devices):
+        """Context manager holding a stream on each of the given devices (e.g. the source and destination
+        devices of a copy). Devices are always taken in the same order, so that callers can't deadlock."""
+        if self.maxstreams <= 0:
+            yield
+            return
+        sems = [self._semaphore(dev) for dev in sorted(set(devices))]
+        for sem in sems:
+            sem.acquire()
+        try:
+            yield
+        finally:
+            for sem in reversed(sems):
+                sem.release()
+
+
+def formatSize(nbytes):
+    """Returns a human-readable size string."""
+    for unit in "B", "kB", "MB", "GB":
+        if nbytes < 1024:
+            return "%d%s" % (nbytes, unit)
+        nbytes //= 1024
+    return "%dTB" % nbytes
+
+
+def _copyData(fsrc, fdst, size, progress):
+    """Copies 'size' bytes from file descriptor fsrc to file descriptor fdst, using the fastest method
+    available. Zero-copy methods that are not supported for this pair of files (e.g. copy_file_range() across
+    filesystems on older kernels) fall back to the next one."""
+    offset = 0
+    for method in "copy_file_range", "sendfile":
+        func = getattr(os, method, None)
+        if func is None:
+            continue
+        try:
+            while offset < size:
+                if method == "copy_file_range":
+                    nbytes = func(fsrc, fdst, min(CHUNK_SIZE, size - offset))
+                else:
+                    nbytes = func(fdst, fsrc, offset, min(CHUNK_SIZE, size - offset))
+                # file has shrunk under us, so we're done
+                if not nbytes:
+                    return
+                offset += nbytes
+                progress.update(nbytes)
+            return
+        except OSError as exc:
+            # these mean the method can't be used for this pair of files, anything else is a real error
+            if exc.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP):
+                raise
+            dprintf(3, "%s not usable here (%s), falling back\n", method, exc)
+            os.lseek(fsrc, offset, os.SEEK_SET)
+            os.lseek(fdst, offset, os.SEEK_SET)
+    # plain copy
+    while True:
+        buf = os.read(fsrc, min(CHUNK_SIZE, 1024 * 1024))
+        if not buf:
+            return
+        os.write(fdst, buf)
+        progress.update(len(buf))
+
+
+def _isUpToDate(sourcepath, destpath):
+    """Returns True if destpath exists and is not older than sourcepath (i.e. the "only if newer" check of
+    cp -u and mv -u)."""
+    try:
+        return os.stat(destpath).st_mtime >= os.stat(sourcepath).st_mtime
+    except OSError:
+        return False
+
+
+def copyFile(sourcepath, destpath, update=True):
+    """Copies file sourcepath to destpath, preserving mode and timestamps (like cp -a).
+    If update is True and destpath is already at least as new as sourcepath, nothing is done (like cp -u).
+    Returns True if the file was copied, False if it was up to date."""
+    if update and _isUpToDate(sourcepath, destpath):
+        dprintf(3, "%s is up to date, not copying\n", destpath)
+        return False
+    # a directory destination means copy into it, like cp does
+    if os.path.isdir(destpath):
+        destpath = os.path.join(destpath, os.path.basename(sourcepath))
+    st = os.stat(sourcepath)
+    progress = _Progress("copying %s" % os.path.basename(sourcepath), st.st_size)
+    fsrc = os.open(sourcepath, os.O_RDONLY)
+    try:
+        fdst = os.open(destpath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, stat.S_IMODE(st.st_mode) | stat.S_IWUSR)
+        try:
+            _copyData(fsrc, fdst, st.st_size, progress)
+        except:
+            os.close(fdst)
+            fdst = None
+            remove(destpath)
+            raise
+        finally:
+            if fdst is not None:
+                os.close(fdst)
+    finally:
+        os.close(fsrc)
+    shutil.copystat(sourcepath, destpath)
+    dprintf(3, "copied %s to %s, %d bytes\n", sourcepath, destpath, st.st_size)
+    return True
+
+
+def cloneFile(sourcepath, destpath):
+    """Makes destpath a reflink (copy-on-write clone) of sourcepath, preserving mode and timestamps.
+    Raises OSError if the filesystem does not support this, in which case destpath is not left behind."""
+    if not HAVE_FCNTL:
+        raise OSError(errno.ENOTSUP, "reflinks are not supported on this platform")
+    st = os.stat(sourcepath)
+    fsrc = os.open(sourcepath, os.O_RDONLY)
+    try:
+        fdst = os.open(destpath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, stat.S_IMODE(st.st_mode) | stat.S_IWUSR)
+        try:
+            fcntl.ioctl(fdst, FICLONE, fsrc)
+        except:
+            os.close(fdst)
+            fdst = None
+            remove(destpath)
+            raise
+        finally:
+            if fdst is not None:
+                os.close(fdst)
+    finally:
+        os.close(fsrc)
+    shutil.copystat(sourcepath, destpath)
+    dprintf(3, "cloned %s to %s\n", sourcepath, destpath)
+
+
+def archiveFile(sourcepath, destpath, mode="copy", update=True):
+    """Copies file sourcepath to destpath using the given archive mode (see ARCHIVE_MODES).
+    Returns the method that was actually used: "reflink", "hardlink" or "copy", or None if update is True and
+    destpath was already up to date (see copyFile())."""
+    if update and _isUpToDate(sourcepath, destpath):
+        dprintf(3, "%s is up to date, not copying\n", destpath)
+        return None
+    if os.path.isdir(destpath):
+        destpath = os.path.join(destpath, os.path.basename(sourcepath))
+    if mode in ("reflink", "link"):
+        try:
+            cloneFile(sourcepath, destpath)
+            return "reflink"
+        except (OSError, IOError) as exc:
+            dprintf(3, "can't reflink %s (%s), falling back\n", sourcepath, exc)
+    # a hard link shares the data with the original, so this is only done for files that nobody can write to
+    if mode == "link" and not os.stat(sourcepath).st_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH):
+        try:
+            remove(destpath)
+            os.link(sourcepath, destpath)
+            dprintf(3, "hard-linked %s to %s\n", sourcepath, destpath)
+            return "hardlink"
+        except OSError as exc:
+            dprintf(3, "can't hard-link %s (%s), falling back\n", sourcepath, exc)
+    copyFile(sourcepath, destpath, update=False)
+    return "copy"
+
+
+def moveFile(sourcepath, destpath, update=True, same_device=None):
+    """Moves file sourcepath to destpath (like mv -f). Within a device this is a rename, else the file is
+    copied, and the source removed once the copy has succeeded.
+    If update is True and destpath is already at least as new as sourcepath, nothing is done, and the
+    source is left alone (like mv -u). Returns True if the file was moved, False if it was up to date.
+    If the caller already knows whether the two are on the same device, it can say so with same_device,
+    else a rename is tried first."""
+    if update and _isUpToDate(sourcepath, destpath):
+        dprintf(3, "%s is up to date, not moving\n", destpath)
+        return False
+    if os.path.isdir(destpath):
+        destpath = os.path.join(destpath, os.path.basename(sourcepath))
+    if same_device is not False:
+        try:
+            os.rename(sourcepath, destpath)
+            dprintf(3, "renamed %s to %s\n", sourcepath, destpath)
+            return True
+        except OSError as exc:
+            if exc.errno != errno.EXDEV:
+                raise
+    copyFile(sourcepath, destpath, update=False)
+    os.unlink(sourcepath)
+    return True
+
+
+def remove(path):
+    """Removes a file, symlink or directory tree (like rm -fr). Paths that do not exist are quietly ignored."""
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return
+    if stat.S_ISDIR(st.st_mode):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+
+def tarDirectory(sourcepath, destpath, arcname=None):
+    """Packs directory sourcepath into a gzipped tarball at destpath. Members are stored relative to the
+    parent of sourcepath (like tar zcf destpath -C parent basename), or under arcname, if given.
+    A failed archive is not left behind."""
+    sourcepath = sourcepath.rstrip('/')
+    basename = arcname or os.path.basename(sourcepath)
+    progress = _Progress("packing %s" % basename, 0)
+
+    def _report(tarinfo):
+        progress.update(tarinfo.size)
+        return tarinfo
+
+    try:
+        with tarfile.open(destpath, "w:gz") as tar:
+            tar.add(sourcepath, arcname=basename, filter=_report)
+    except:
+        remove(destpath)
+        raise
+    dprintf(3, "packed %s into %s, %d bytes\n", sourcepath, destpath, progress.done)
+
+
+# background packing jobs: dict of destpath: future
+_pending = {}  # type: Dict[str, concurrent.futures.Future]
+_pending_lock = threading.Lock()
+_pool = None
+
+
+def stagingPath(destpath):
+    """Returns the staging path used by moveDirectory() for a tarball at destpath."""
+    dirname, basename = os.path.split(destpath)
+    return os.path.join(dirname, ".%s.purr-staging" % basename)
+
+
+def _packStaged(staging, destpath, arcname):
+    try:
+        t0 = time.time()
+        tarDirectory(staging, destpath, arcname=arcname)
+        remove(staging)
+        dprintf(1, "packed %s in the background in %.2fs\n", destpath, time.time() - t0)
+    except:
+        # the staged directory is kept, so nothing is lost
+        print(("Error packing %s into %s, the directory has been left in %s" % (arcname, destpath, staging)))
+        traceback.print_exc()
+        raise
+    finally:
+        with _pending_lock:
+            _pending.pop(destpath, None)
+
+
+def moveDirectory(sourcepath, destpath, same_device=None, background=True):
+    """Moves directory sourcepath into a tarball at destpath. Within a device, the directory is renamed into
+    a staging area next to destpath, and packed from there -- in a worker thread if background is True,
+    in which case this returns right after the rename. Else it is packed in place, and removed afterwards.
+    Errors are raised if the tarball could not be made (in the foreground), in which case the source is left alone."""
+    sourcepath = sourcepath.rstrip('/')
+    arcname = os.path.basename(sourcepath)
+    if same_device is not False:
+        staging = stagingPath(destpath)
+        remove(staging)
+        try:
+            os.rename(sourcepath, staging)
+        except OSError as exc:
+            if exc.errno != errno.EXDEV:
+                raise
+        else:
+            dprintf(3, "renamed %s to %s\n", sourcepath, staging)
+            if not background:
+                _packStaged(staging, destpath, arcname)
+                return
+            global _pool
+            with _pending_lock:
+                if _pool is None:
+                    _pool = concurrent.futures.ThreadPoolExecutor(2)
+                _pending[destpath] = _pool.submit(_packStaged, staging, destpath, arcname)
+            return
+    tarDirectory(sourcepath, destpath)
+    # the archive is complete at this point, so failing to remove the source is not fatal
+    try:
+        remove(sourcepath)
+    except OSError as exc:
+        print(("Error removing %s after archiving it: %s" % (sourcepath, exc)))
+
+
+def waitFor(path):
+    """Waits for background packing of the tarball at 'path', or of any tarballs under directory 'path', to
+    finish. Errors in the background jobs have been reported already, and are not raised again."""
+    with _pending_lock:
+        futures = [future for destpath, future in _pending.items()
+                   if destpath == path or destpath.startswith(path.rstrip('/') + '/')]
+    if futures:
+        dprintf(2, "waiting for %d background jobs under %s\n", len(futures), path)
+        concurrent.futures.wait(futures)
+
+
+def recoverStaged(destpath, arcname):
+    """Makes sure the tarball at destpath is complete, if moveDirectory() was asked to make it. Waits for its
+    background packing job if there is one. If there isn't, but the directory is still in the staging area (e.g. because
+    Purr was killed before the job finished), it is packed now. Returns True if the tarball exists."""
+    with _pending_lock:
+        future = _pending.get(destpath)
+    if future is not None:
+        concurrent.futures.wait([future])
+    elif not os.path.exists(destpath):
+        staging = stagingPath(destpath)
+        if os.path.isdir(staging):
+            print(("Found unpacked data product %s, packing it into %s" % (staging, destpath)))
+            try:
+                _packStaged(staging, destpath, arcname)
+            except (OSError, IOError, tarfile.TarError):
+                pass
+    return os.path.exists(destpath)
+
+
+def untarDirectory(tarpath, parent_dir):
+    """Unpacks a tarball made by tarDirectory() into parent_dir (like tar zxf tarpath -C parent_dir)."""
+    with tarfile.open(tarpath, "r:*") as tar:
+        # members with absolute paths or ".." components are refused, where this version of Python can check
+        if hasattr(tarfile, 'tar_filter'):
+            tar.extractall(parent_dir, filter='tar')
+        else:
+            tar.extractall(parent_dir)
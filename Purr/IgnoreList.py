@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""Purr.IgnoreList keeps track of files that the purrlog user has chosen to ignore.
+
+For every ignored file, the store keeps the file's timestamp at the time it was last ignored, and the
+policy ("ignore" or "banish") that was applied. When a purrlog is re-attached, watchers of these files are
+given timestamps no older than this, so that Purr does not pounce on them again.
+
+The store is an SQLite database (ignorelist.db) in the purrlog, keyed by path, so it holds one record per
+file no matter how often the file is ignored, and can be looked up one path at a time. Older versions of
+Purr kept an append-only text file (ignorelist) instead. This is migrated into the database when the
+store is opened, and then renamed to ignorelist.migrated.
+"""
+
+import os
+import os.path
+import sqlite3
+import threading
+import traceback
+
+from Purr import dprint, dprintf
+
+DATABASE = "ignorelist.db"
+OLD_IGNORELIST = "ignorelist"
+
+
+class IgnoreList(object):
+    def __init__(self, logdir):
+        self.filename = os.path.join(logdir, DATABASE)
+        self._lock = threading.Lock()
+        # the store may be written from the GUI thread and read from the rescan worker, so the connection
+        # is shared across threads, and serialized by our own lock
+        self._db = sqlite3.connect(self.filename, check_same_thread=False)
+        with self._lock, self._db:
+            # auto_vacuum only takes effect on a new database, so it has to be set before the table is created
+            self._db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            self._db.execute("""CREATE TABLE IF NOT EXISTS ignores
+                                (path TEXT PRIMARY KEY, timestamp INTEGER, policy TEXT)""")
+        self._migrate(os.path.join(logdir, OLD_IGNORELIST))
+        # give back space freed up by deleted records
+        with self._lock:
+            self._db.execute("PRAGMA incremental_vacuum")
+        dprintf(1, "opened %s, %d ignored files\n", self.filename, len(self))
+
+    def _migrate(self, oldfile):
+        """Imports an old-style ignorelist file. This is a list of lines of the form "timestamp policy filename".
+        Later lines override earlier ones."""
+        if not os.path.exists(oldfile):
+            return
+        ignores = {}
+        try:
+            for line in open(oldfile):
+                timestamp, policy, filename = line.strip().split(" ", 2)
+                ignores[filename] = int(timestamp), policy
+        except:
+            print(("Error reading %s" % oldfile))
+            traceback.print_exc()
+        with self._lock, self._db:
+            self._db.executemany("INSERT OR REPLACE INTO ignores VALUES (?,?,?)",
+                                 [(path, timestamp, policy) for path, (timestamp, policy) in ignores.items()])
+        try:
+            os.rename(oldfile, oldfile + ".migrated")
+        except:
+            print(("Error renaming %s" % oldfile))
+            traceback.print_exc()
+        dprint(1, "migrated", len(ignores), "entries from", oldfile)
+
+    def add(self, path, timestamp, policy):
+        """Records that 'path' was ignored with the given policy, when its timestamp was 'timestamp'."""
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO ignores VALUES (?,?,?)", (path, int(timestamp), policy))
+
+    def lookup(self, path):
+        """Returns (timestamp, policy) tuple for 'path', or None if it has not been ignored."""
+        with self._lock:
+            return self._db.execute("SELECT timestamp, policy FROM ignores WHERE path=?", (path,)).fetchone()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM ignores").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""Purr.Journal keeps an append-only journal of what a Purrer has seen and done since its last checkpoint.
+
+The watcher snapshot (watchstate.gz) is only written on detach, so if Purr crashes or is killed, the next
+attach would start from an old snapshot, and pounce again on everything that has appeared since. To avoid
+this, the Purrer appends a record to the journal (journal.jsonl in the purrlog) whenever something
+happens that changes its state: a watcher that has found new files or whose directory listing has changed
+("watch" events), a pounce ("pounce"), a policy decision on a data product ("policy"), or a saved entry
+("entry"). A "watch" record carries the watcher's full state the first time the watcher appears in the
+journal. After that, a record only carries the changes ("delta"): the new mtime, and the names added to
+and removed from the directory listing. Each record is a JSON object on a line of its own, with the event type under "ev" and the
+time under "t".
+
+Writing the watcher snapshot is a checkpoint: the snapshot then covers everything in the journal, so the
+journal is truncated. On attach, the records written since the checkpoint are replayed on top of the
+snapshot, so restarting after a crash costs O(events since last checkpoint).
+"""
+
+import json
+import os
+import os.path
+import threading
+import time
+import traceback
+
+from Purr import dprintf
+
+JOURNAL = "journal.jsonl"
+
+
+class Journal(object):
+    def __init__(self, logdir):
+        self.filename = os.path.join(logdir, JOURNAL)
+        self._lock = threading.Lock()
+        self._fobj = open(self.filename, 'a')
+        self._nrecords = None
+
+    def append(self, ev, **fields):
+        """Appends a record of event 'ev' to the journal. Other fields of the record are given as keyword arguments.
+        The record is flushed out immediately, so that it survives a crash of Purr."""
+        fields['ev'] = ev
+        fields['t'] = time.time()
+        line = json.dumps(fields, separators=(',', ':')) + "\n"
+        with self._lock:
+            if self._fobj is None:
+                return
+            try:
+                self._fobj.write(line)
+                self._fobj.flush()
+                if self._nrecords is not None:
+                    self._nrecords += 1
+            except:
+                print(("Error writing %s" % self.filename))
+                traceback.print_exc()
+
+    def replay(self):
+        """Returns list of records in the journal, in order of writing. Malformed lines (e.g. one left
+        half-written by a crash) are skipped."""
+        records = []
+        with self._lock:
+            try:
+                nlines = 0
+                for line in open(self.filename):
+                    nlines += 1
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        record = None
+                    if isinstance(record, dict) and 'ev' in record and 't' in record:
+                        records.append(record)
+                    else:
+                        dprintf(1, "%s: skipping malformed line %d\n", self.filename, nlines)
+            except:
+                print(("Error reading %s" % self.filename))
+                traceback.print_exc()
+            self._nrecords = len(records)
+        dprintf(1, "read journal %s: %d records\n", self.filename, len(records))
+        return records
+
+    def checkpoint(self):
+        """Truncates the journal. Called once the Purrer's state has been safely written elsewhere."""
+        with self._lock:
+            if self._fobj is None:
+                return
+            try:
+                self._fobj.truncate(0)
+                self._nrecords = 0
+                dprintf(2, "truncated journal %s\n", self.filename)
+            except:
+                print(("Error truncating %s" % self.filename))
+                traceback.print_exc()
+
+    def __len__(self):
+        """Returns number of records written since the last checkpoint."""
+        with self._lock:
+            if self._nrecords is None:
+                self._nrecords = sum([1 for line in open(self.filename)])
+            return self._nrecords
+
+    def close(self):
+        with self._lock:
+            if self._fobj is not None:
+                self._fobj.close()
+                self._fobj = None
@@ -1,39 +1,29 @@
 # -*- coding: utf-8 -*-
+import concurrent.futures
 import os
 import os.path
 import re
+import stat
 import sys
+import tarfile
 import time
 import traceback
 
 import Purr
+import Purr.Archiver
+import Purr.Manifest
+import Purr.ObjectStore
 import Purr.Render
 import Purr.RenderIndex
-from Purr import dprint, dprintf, verbosity
+from Purr import Config, dprint, dprintf, verbosity
 from Purr.Render import quote_url
 
 
-def _copy_update(sourcepath, destname):
-    """Copy source to dest only if source is newer."""
-    if sys.platform.startswith('linux'):
-        return os.system("/bin/cp -ua '%s' '%s'" % (sourcepath, destname))
-    else:
-        return os.system("rsync -ua '%s' '%s'" % (sourcepath, destname))
-
-
-def _move_update(sourcepath, destname):
-    """Move source to dest only if source is newer."""
-    if sys.platform.startswith('linux'):
-        return os.system("/bin/mv -fu '%s' '%s'" % (sourcepath, destname))
-    else:
-        return os.system("rsync -ua --remove-source-files '%s' '%s'" % (sourcepath, destname))
-
-
 class DataProduct(object):
     def __init__(self, filename=None, sourcepath=None, fullpath=None,
                  policy="copy", comment="",
                  timestamp=None, render=None,
-                 quiet=False, archived=False):
+                 quiet=False, archived=False, archive=None, archive_mode=None, hash=None):
         # This is the absolute pathname to the original data product
         self.sourcepath = Purr.canonizePath(sourcepath)
         # Base filename (w/o path) of data product within the log storage area.
@@ -54,6 +44,14 @@ class DataProduct(object):
         self.quiet = quiet
         # if True, DP has already been archived. This is False for new DPs until they're saved.
         self.archived = archived
+        # How the archived copy was made: "copy", "reflink", "hardlink", "store", "move" or "tgz".
+        # None if not archived yet, or archived by an older version of Purr (in which case it is a copy).
+        self.archive = archive
+        # How the DP is to be archived under the "copy" policy (see Purr.Archiver.ARCHIVE_MODES).
+        # This is set from the archive-modes configuration when the DP is made.
+        self.archive_mode = archive_mode
+        # SHA-256 of the archived content, if the DP was archived via the object store (see Purr.ObjectStore)
+        self.hash = hash
         # if True, dp is ignored (policy is "ignore" or "banish")
         # not that policy should not be changed after a DP has been created
         self.ignored = policy in ("ignore", "banish")
@@ -77,6 +75,11 @@ class DataProduct(object):
             os.remove(self.fullpath)
         except:
             print(("Error removing %s: %s" % (self.fullpath, sys.exc_info()[1])))
+        # the object may now be unused
+        if self.hash:
+            store = Purr.ObjectStore.getStore(os.path.dirname(os.path.dirname(self.fullpath)))
+            if store:
+                store.release([self.hash])
 
     def remove_subproducts(self):
         """Removes all archived files subproducts associated with this DP"""
@@ -136,9 +139,16 @@ class DataProduct(object):
                                         QMessageBox.Yes, QMessageBox.No) != QMessageBox.Yes:
                     return False
         busy = Purr.BusyIndicator()
+        # if the archived copy is still being packed, it needs to be finished first
+        Purr.Archiver.waitFor(self.fullpath)
+        # a hard-linked archive may still be the very same file as the original, then there's nothing to do
+        linked = self.archive == "hardlink" and exists and os.path.samefile(self.fullpath, self.sourcepath)
         # remove file if in the way
-        if exists:
-            if os.system("/bin/rm -fr '%s'" % self.sourcepath):
+        if exists and not linked:
+            try:
+                Purr.Archiver.remove(self.sourcepath)
+            except (OSError, IOError) as exc:
+                print(("Error removing %s: %s" % (self.sourcepath, exc)))
                 busy = None
                 if parent:
                     QMessageBox.warning(parent, "Error removing file", """<P>
@@ -149,17 +159,29 @@ class DataProduct(object):
         # unpack archived file
         if self.fullpath.endswith('.tgz'):
             parent_dir = os.path.dirname(self.sourcepath.rstrip('/'))
-            os.system("/bin/rm -fr %s" % self.sourcepath)
-            if os.system("tar zxf '%s' -C '%s'" % (self.fullpath, parent_dir)):
+            try:
+                Purr.Archiver.remove(self.sourcepath)
+                Purr.Archiver.untarDirectory(self.fullpath, parent_dir)
+            except (OSError, IOError, tarfile.TarError) as exc:
+                print(("Error unpacking %s to %s: %s" % (self.fullpath, parent_dir, exc)))
                 busy = None
                 if parent:
                     QMessageBox.warning(parent, "Error unpacking file", """<P>
             There was an error unpacking the archived version to %s. The text console may have more information.</P>""" % self.sourcepath,
                                         QMessageBox.Ok, 0)
                 return False
-        # else simply copy over
+        elif linked:
+            dprintf(2, "%s is hard-linked to its archived copy, nothing to restore\n", self.sourcepath)
+        # else simply copy over. This never makes a hard link, since the restored file must be independent
+        # of the archived one.
         else:
-            if os.system("/bin/cp -a '%s' '%s'" % (self.fullpath, self.sourcepath)):
+            try:
+                Purr.Archiver.archiveFile(self.fullpath, self.sourcepath, mode="reflink", update=False)
+                # objects in the store are read-only, the restored file shouldn't be
+                if self.archive == "store":
+                    os.chmod(self.sourcepath, os.stat(self.sourcepath).st_mode | stat.S_IWUSR)
+            except (OSError, IOError) as exc:
+                print(("Error copying %s to %s: %s" % (self.fullpath, self.sourcepath, exc)))
                 busy = None
                 if parent:
                     QMessageBox.warning(parent, "Error copying file", """<P>
@@ -174,10 +196,31 @@ class DataProduct(object):
         return True
 
 
+class DataProductRecord(object):
+    """A lightweight read-only view of a data product's manifest record. This has the attributes that the
+    Purrer needs to set up default policies and watchers, without the cost of a full DataProduct."""
+
+    __slots__ = ("sourcepath", "filename", "policy", "comment", "quiet", "timestamp", "ignored", "hash")
+
+    def __init__(self, record):
+        self.sourcepath = record['sourcepath']
+        self.filename = record['filename'] or os.path.basename(self.sourcepath)
+        self.policy = record['policy']
+        self.comment = record['comment'] or ""
+        self.quiet = record['quiet']
+        self.timestamp = record['timestamp']
+        self.hash = record.get('hash')
+        self.ignored = self.policy in ("ignore", "banish")
+
+
 class LogEntry(object):
     """This represents a LogEntry object"""
 
-    def __init__(self, timestamp=None, title="", comment="", dps=[], load=None, ignore=False):
+    # Attributes that a lazily loaded entry only sets up on first access. See load() and __getattr__()
+    _lazy_attrs = ("comment", "dps", "cached_include_valid", "updated")
+
+    def __init__(self, timestamp=None, title="", comment="", dps=[], load=None, ignore=False, record=None,
+                 lazy=False):
         self.title, self.comment, self.dps = title, comment, dps
         self.timestamp = timestamp or int(time.time())
         self.pathname = None
@@ -194,7 +237,7 @@ class LogEntry(object):
         # set to True when something changes, or if load() detects that renderers have been updated.
         self.updated = True
         if load:
-            self.load(load)
+            self.load(load, record=record, lazy=lazy)
         # QTreeWidgetItem associated with this log entry
         self.tw_item = None
         # next/prev/up links
@@ -217,8 +260,52 @@ class LogEntry(object):
         if timestamp is not None:
             self.timestamp = timestamp
 
-    def load(self, pathname):
-        """Loads entry from directory."""
+    def __getattr__(self, name):
+        # this is only called when normal attribute lookup fails, i.e. for the lazy attributes of an entry
+        # that hasn't been fully loaded yet
+        record = self.__dict__.get('_lazy_record')
+        if record is None or name not in LogEntry._lazy_attrs:
+            raise AttributeError(name)
+        # the comment is in the record, so it can be set up without touching the filesystem
+        if name == "comment":
+            self.comment = record['comment'] or ""
+        else:
+            self._materialize()
+        return self.__dict__[name]
+
+    def isLoaded(self):
+        """Returns False if this is a lazily loaded entry whose data products have not been set up yet."""
+        return '_lazy_record' not in self.__dict__
+
+    def dataProductInfo(self):
+        """Returns list of the entry's data products. For an entry that has not been fully loaded, this is a list
+        of DataProductRecords made from its manifest record, so calling this does not load the entry."""
+        record = self.__dict__.get('_lazy_record')
+        if record is None:
+            return self.dps
+        return [DataProductRecord(dp) for dp in record['dps']]
+
+    def _materialize(self):
+        """Finishes loading a lazily loaded entry. Attributes that have been set in the meantime
+        (e.g. by update()) are left alone."""
+        record = self.__dict__.pop('_lazy_record')
+        dprintf(2, "loading data products of entry %s\n", self.pathname)
+        if 'comment' not in self.__dict__:
+            self.comment = record['comment'] or ""
+        if 'dps' not in self.__dict__:
+            self.dps = [dp for dp in self._recordDataProducts(self.pathname, record) if self._dpExists(dp)]
+        valid, updated = self._checkIncludeCache()
+        if 'cached_include_valid' not in self.__dict__:
+            self.cached_include_valid = valid
+        if 'updated' not in self.__dict__:
+            self.updated = updated
+
+    def load(self, pathname, record=None, lazy=False):
+        """Loads entry from directory.
+        'record' is the entry's record from the purrlog manifest, if any. If the record is up to date,
+        the entry is loaded from it, else index.html is parsed.
+        If 'lazy' is True and the record is up to date, only the title and timestamp are set up here. The
+        comment, data products and cache state are set up on first access."""
         match = self._entry_re.match(pathname)
         if not match:
             return None
@@ -227,15 +314,57 @@ class LogEntry(object):
             raise ValueError("%s: not a directory" % pathname)
         if not os.access(pathname, os.R_OK | os.W_OK):
             raise ValueError("%s: insufficient access privileges" % pathname)
-        # parse index.html file
-        parser = Purr.Parsers.LogEntryIndexParser(pathname)
         self.index_file = os.path.join(pathname, 'index.html')
-        for i, line in enumerate(open(self.index_file)):
-            try:
-                parser.feed(line)
-            except:
-                dprintf(0, "parse error at line %d of %s\n", i, self.index_file)
-                raise
+        self.pathname = pathname
+        self.cached_include = os.path.join(pathname, 'index.include.html')
+        if record is not None and Purr.Manifest.isCurrent(record, self.index_file):
+            if lazy:
+                dprintf(2, "lazily loading entry %s from manifest\n", pathname)
+                self.timestamp = int(record['timestamp'])
+                self.title = record['title']
+                for attr in LogEntry._lazy_attrs:
+                    self.__dict__.pop(attr, None)
+                self._lazy_record = record
+                return
+            dprintf(2, "loading entry %s from manifest\n", pathname)
+            self._loadRecord(pathname, record)
+        else:
+            self._loadIndex(pathname)
+            # bring the manifest up to date, so that the index doesn't need to be parsed next time
+            Purr.Manifest.addEntry(self)
+        # see if any data products have been removed on us
+        self.dps = [dp for dp in self.dps if self._dpExists(dp)]
+        self.cached_include_valid, self.updated = self._checkIncludeCache()
+
+    @staticmethod
+    def _dpExists(dp):
+        """Checks that an archived data product is still there. A directory that was moved into a tarball
+        may still be in the staging area (see Purr.Archiver.moveDirectory()), in which case it is packed now."""
+        if os.path.exists(dp.fullpath):
+            return True
+        if dp.archive == "tgz" and dp.sourcepath:
+            return Purr.Archiver.recoverStaged(dp.fullpath, os.path.basename(dp.sourcepath.rstrip('/')))
+        return False
+
+    def _checkIncludeCache(self):
+        """Checks if the cached include file is up-to-date, and if the entry needs to be re-rendered.
+        Returns tuple of (cached_include_valid, updated) flags."""
+        cache = self.cached_include
+        mtime = (os.path.exists(cache) or 0) and os.path.getmtime(cache)
+        index_mtime = os.path.getmtime(self.index_file)
+        if mtime >= max(Purr.Render.youngest_renderer, index_mtime):
+            dprintf(2, "entry %s has a valid include cache\n", self.pathname)
+            valid = True
+        else:
+            dprintf(2, "entry %s does not have a valid include cache\n", self.pathname)
+            valid = False
+        # mark entry as unchanged, if renderers are older than index
+        return valid, (Purr.Render.youngest_renderer > index_mtime)
+
+    def _loadIndex(self, pathname):
+        """Sets up entry by parsing its index.html file."""
+        parser = Purr.Parsers.LogEntryIndexParser(pathname)
+        parser.parseFile(self.index_file)
         # set things up from parser
         try:
             self.timestamp = int(float(parser.timestamp))
@@ -246,20 +375,23 @@ class LogEntry(object):
             self.title = "Malformed entry, probably needs to be deleted"
         self.comment = getattr(parser, 'comments', None) or ""
         self.dps = getattr(parser, 'dps', [])
-        self.pathname = pathname
-        # see if any data products have been removed on us
-        self.dps = [dp for dp in self.dps if os.path.exists(dp.fullpath)]
-        # see if the cached include file is up-to-date
-        self.cached_include = cache = os.path.join(pathname, 'index.include.html')
-        mtime = (os.path.exists(cache) or 0) and os.path.getmtime(cache)
-        if mtime >= max(Purr.Render.youngest_renderer, os.path.getmtime(self.index_file)):
-            dprintf(2, "entry %s has a valid include cache\n", pathname)
-            self.cached_include_valid = True
-        else:
-            dprintf(2, "entry %s does not have a valid include cache\n", pathname)
-            self.cached_include_valid = False
-        # mark entry as unchanged, if renderers are older than index
-        self.updated = (Purr.Render.youngest_renderer > os.path.getmtime(self.index_file))
+
+    def _loadRecord(self, pathname, record):
+        """Sets up entry from its manifest record."""
+        self.timestamp = int(record['timestamp'])
+        self.title = record['title']
+        self.comment = record['comment'] or ""
+        self.dps = self._recordDataProducts(pathname, record)
+
+    @staticmethod
+    def _recordDataProducts(pathname, record):
+        """Makes list of DataProducts from a manifest record."""
+        return [DataProduct(filename=dp['filename'], sourcepath=dp['sourcepath'],
+                            timestamp=dp['timestamp'], comment=dp['comment'] or "",
+                            fullpath=os.path.join(pathname, dp['filename'] or ""),
+                            policy=dp['policy'], render=dp['render'], quiet=dp['quiet'], archived=True,
+                            archive=dp.get('archive'), hash=dp.get('hash'))
+                for dp in record['dps']]
 
     def _relIndexLink(self):
         """Returns relative link to index.html of this entry. Link will be of the form ../entry-xxx/index.html"""
@@ -300,22 +432,75 @@ class LogEntry(object):
         devnum = os.stat(pathname).st_dev
         # copy data products as needed
         dprintf(2, "saving entry %s, %d data products\n", pathname, len(self.dps))
-        dps = []
+        # copied files go through the object store, if one is enabled
+        try:
+            store = Purr.ObjectStore.getStore(os.path.dirname(pathname))
+        except:
+            print("Error opening object store, data products will be copied instead")
+            traceback.print_exc()
+            store = None
+        # data products to be archived, in order. Previously archived DPs (i.e. those already saved),
+        # and ignored DPs (no need to save them) are kept in the list as they are.
+        todo = []
         for dp in self.dps:
-            # if archived, this indicates a previously saved data product, so ignore it
-            # if ignored, no need to save the DP -- but keep it in list
             if dp.archived or dp.ignored:
                 dprintf(3, "dp %s is archived or ignored, skipping\n", dp.sourcepath)
-                dps.append(dp)
-                continue
-            # file missing for some reason (perhaps it got removed on us?) skip data product entirely
-            if not os.path.exists(dp.sourcepath):
-                dprintf(2, "data product %s missing, ignoring\n", dp.sourcepath)
-                continue
-            Purr.progressMessage("archiving %s" % dp.filename, sub=True)
-            # get normalized source and destination paths
-            dprintf(2, "data product: %s, rename %s, policy %s\n", dp.sourcepath, dp.filename, dp.policy)
-            sourcepath = Purr.canonizePath(dp.sourcepath)
+            else:
+                todo.append(dp)
+        limiter = Purr.Archiver.DeviceLimiter(Config.getint("archive-device-streams", 2))
+        nworkers = min(Config.getint("archive-workers", 0), len(todo))
+        results = []
+        # with more than one worker, DPs are archived concurrently. Progress is only reported here, as each
+        # result comes in, since the GUI can't be updated from the workers.
+        if nworkers > 1:
+            dprintf(1, "archiving %d data products using %d workers\n", len(todo), nworkers)
+            Purr.progressMessage("archiving %d data products" % len(todo), sub=True)
+            with concurrent.futures.ThreadPoolExecutor(nworkers) as pool:
+                futures = [pool.submit(self._archiveDataProduct, dp, pathname, devnum, store, limiter)
+                           for dp in todo]
+                for dp, future in zip(todo, futures):
+                    try:
+                        results.append(future.result())
+                    except:
+                        print(("Error archiving %s" % dp.sourcepath))
+                        traceback.print_exc()
+                        print("This data product is not saved.")
+                        results.append(None)
+                    if results[-1]:
+                        Purr.progressMessage("archived %s: %s in %.1fs" % ((dp.filename,) + results[-1]), sub=True)
+        else:
+            for dp in todo:
+                Purr.progressMessage("archiving %s" % dp.filename, sub=True)
+                results.append(self._archiveDataProduct(dp, pathname, devnum, store, limiter))
+                if results[-1]:
+                    Purr.progressMessage("archived %s: %s in %.1fs" % ((dp.filename,) + results[-1]), sub=True)
+        # reset list of data products, dropping those that failed to archive
+        saved = set([id(dp) for dp, result in zip(todo, results) if result])
+        self.dps = [dp for dp in self.dps if dp.archived or dp.ignored or id(dp) in saved]
+        # now write out content
+        self.cached_include = os.path.join(pathname, 'index.include.html')
+        self.cached_include_valid = False
+        self.index_file = os.path.join(pathname, "index.html")
+        self.generateIndex(refresh=refresh, refresh_index=refresh_index and time.time())
+        self.updated = False
+
+    def _archiveDataProduct(self, dp, pathname, devnum, store, limiter):
+        """Archives a data product into the entry directory 'pathname' (on device 'devnum'), through the object
+        store if 'store' is not None. This may be called from a worker thread. Errors are reported here.
+        Returns (action, elapsed) on success, where action describes what was done, or None if the DP was not saved.
+        """
+        # file missing for some reason (perhaps it got removed on us?) skip data product entirely
+        if not os.path.exists(dp.sourcepath):
+            dprintf(2, "data product %s missing, ignoring\n", dp.sourcepath)
+            return None
+        # get normalized source and destination paths
+        dprintf(2, "data product: %s, rename %s, policy %s\n", dp.sourcepath, dp.filename, dp.policy)
+        sourcepath = Purr.canonizePath(dp.sourcepath)
+        # moves within the same device can be done by renaming
+        srcdev = os.stat(sourcepath).st_dev
+        same_device = srcdev == devnum
+        with limiter.streams(srcdev, devnum):
+            t0 = time.time()
             destname = dp.fullpath = os.path.join(pathname, dp.filename)
             dprintf(2, "data product: %s -> %s\n", sourcepath, destname)
             # does the destination product already exist? skip if same file, else remove
@@ -323,51 +508,81 @@ class LogEntry(object):
                 if os.path.samefile(destname, sourcepath):
                     dprintf(2, "same file, skipping\n")
                     dp.timestamp = os.path.getmtime(destname)
-                    dps.append(dp)
-                    continue
-                if os.system("/bin/rm -fr '%s'" % destname):
-                    print(("Error removing %s, which is in the way of %s" % (destname, sourcepath)))
+                    dp.archive = dp.archive or "hardlink"
+                    return "already in place", time.time() - t0
+                try:
+                    Purr.Archiver.remove(destname)
+                except (OSError, IOError) as exc:
+                    print(("Error removing %s, which is in the way of %s: %s" % (destname, sourcepath, exc)))
                     print("This data product is not saved.")
-                    continue
+                    return None
             # for directories, compress with tar
             if os.path.isdir(sourcepath):
                 sourcepath = sourcepath.rstrip('/')
-                if dp.policy == "copy" or dp.policy.startswith("move"):
+                if dp.policy == "copy":
                     dprintf(2, "archiving to tgz\n")
-                    if os.system("tar zcf '%s' -C '%s' '%s'" % (destname,
-                                                                os.path.dirname(sourcepath),
-                                                                os.path.basename(sourcepath))):
-                        print(("Error archiving %s to %s" % (sourcepath, destname)))
+                    action = dp.archive = "tgz"
+                    try:
+                        Purr.Archiver.tarDirectory(sourcepath, destname)
+                    except (OSError, IOError, tarfile.TarError) as exc:
+                        print(("Error archiving %s to %s: %s" % (sourcepath, destname, exc)))
                         print("This data product is not saved.")
-                        continue
-                    if dp.policy.startswith("move"):
-                        os.system("/bin/rm -fr '%s'" % sourcepath)
+                        return None
+                # within a device, the directory is renamed out of the way, and packed in the background
+                elif dp.policy.startswith("move"):
+                    dprintf(2, "moving to tgz, same device: %s\n", same_device)
+                    action = "renamed, packing in background" if same_device else "packed and removed"
+                    dp.archive = "tgz"
+                    try:
+                        Purr.Archiver.moveDirectory(sourcepath, destname, same_device=same_device)
+                    except (OSError, IOError, tarfile.TarError) as exc:
+                        print(("Error archiving %s to %s: %s" % (sourcepath, destname, exc)))
+                        print("This data product is not saved.")
+                        return None
+                else:
+                    action = "skipped"
             # else just a file
             else:
                 # now copy/move it over
-                if dp.policy == "copy":
-                    dprintf(2, "copying\n")
-                    if _copy_update(sourcepath, destname):
-                        print(("Error copying %s to %s" % (sourcepath, destname)))
+                if dp.policy == "copy" and store:
+                    dprintf(2, "archiving to object store\n")
+                    action = dp.archive = "store"
+                    try:
+                        dp.hash = store.archive(sourcepath, destname)
+                    except (OSError, IOError) as exc:
+                        print(("Error storing %s as %s: %s" % (sourcepath, destname, exc)))
+                        print("This data product is not saved.")
+                        return None
+                elif dp.policy == "copy":
+                    dprintf(2, "copying, archive mode %s\n", dp.archive_mode)
+                    try:
+                        action = dp.archive = \
+                            Purr.Archiver.archiveFile(sourcepath, destname, dp.archive_mode or "copy") or "copy"
+                    except (OSError, IOError) as exc:
+                        print(("Error copying %s to %s: %s" % (sourcepath, destname, exc)))
                         print("This data product is not saved.")
-                        continue
+                        return None
                 elif dp.policy.startswith('move'):
-                    if _move_update(sourcepath, destname):
-                        print(("Error moving %s to %s" % (sourcepath, destname)))
+                    action = "renamed" if same_device else "copied and removed"
+                    dp.archive = "move"
+                    try:
+                        Purr.Archiver.moveFile(sourcepath, destname, same_device=same_device)
+                    except (OSError, IOError) as exc:
+                        print(("Error moving %s to %s: %s" % (sourcepath, destname, exc)))
                         print("This data product is not saved.")
-                        continue
-            # success, set timestamp and append
-            dp.timestamp = os.path.getmtime(destname)
+                        return None
+                else:
+                    action = "skipped"
+            # success, set timestamp. A directory that is still being packed has its timestamp
+            # taken from the staging area.
+            if os.path.exists(destname):
+                dp.timestamp = os.path.getmtime(destname)
+            else:
+                dp.timestamp = os.path.getmtime(Purr.Archiver.stagingPath(destname))
             dp.archived = True
-            dps.append(dp)
-        # reset list of data products
-        self.dps = dps
-        # now write out content
-        self.cached_include = os.path.join(pathname, 'index.include.html')
-        self.cached_include_valid = False
-        self.index_file = os.path.join(pathname, "index.html")
-        self.generateIndex(refresh=refresh, refresh_index=refresh_index and time.time())
-        self.updated = False
+            elapsed = time.time() - t0
+        dprintf(1, "archived %s (%s): %s in %.2fs\n", dp.filename, dp.policy, action, elapsed)
+        return action, elapsed
 
     def setPrevUpNextLinks(self, prev=None, up=None, next=None):
         """Sets Prev link to point to the LogEntry object "prev". Set that object's Next link to point to us. Sets the "up" link to the URL 'up' (if up != None.)
@@ -384,15 +599,24 @@ class LogEntry(object):
             self._next_link = next and quote_url(next._relIndexLink())
 
     def generateIndex(self, refresh=0, refresh_index=0):
-        """Writes the index file"""
+        """Writes the index file, and records the entry in the purrlog manifest"""
         open(self.index_file, "wt").write(self.renderIndex(refresh=refresh, refresh_index=refresh_index))
+        Purr.Manifest.addEntry(self)
 
     def remove_directory(self):
         """Removes this entry's directory from disk"""
         if not self.pathname:
             return
-        if os.system("/bin/rm -fr '%s'" % self.pathname):
-            print("Error removing %s")
+        Purr.Archiver.waitFor(self.pathname)
+        try:
+            Purr.Archiver.remove(self.pathname)
+        except (OSError, IOError) as exc:
+            print(("Error removing %s: %s" % (self.pathname, exc)))
+        # objects that were only linked from this entry are no longer needed
+        hashes = [dp.hash for dp in self.dataProductInfo() if getattr(dp, 'hash', None)]
+        store = hashes and Purr.ObjectStore.getStore(os.path.dirname(self.pathname))
+        if store:
+            store.release(hashes)
 
     def timeLabel(self):
         return time.strftime("%x %X", time.localtime(self.timestamp))
@@ -412,6 +636,9 @@ class LogEntry(object):
         dprintf(2, "%s: rendering HTML index with relpath='%s', refresh=%s refresh_index=%s\n", self.pathname, relpath,
                 time.strftime("%x %X", time.localtime(refresh)),
                 time.strftime("%x %X", time.localtime(refresh_index)))
+        # an entry that hasn't been fully loaded can check its cache without loading its data products
+        if relpath and 'cached_include_valid' not in self.__dict__ and not self.isLoaded():
+            self.cached_include_valid = self._checkIncludeCache()[0]
         if relpath and self.cached_include_valid:
             try:
                 if os.path.getmtime(self.cached_include) >= refresh_index:
@@ -426,6 +653,8 @@ class LogEntry(object):
                     dprint(1, "Error traceback follows:")
                     traceback.print_exc()
                 self.cached_include_valid = False
+        if not self.isLoaded():
+            self._materialize()
         # form up attributes for % operator
         attrs = dict(self.__dict__)
         attrs['timestr'] = time.strftime("%x %X", time.localtime(self.timestamp))
@@ -477,6 +706,8 @@ class LogEntry(object):
         <TABLE BORDER=1 FRAME=box RULES=all CELLPADDING=5>\n"""
             for dp in self.dps:
                 dpattrs = dict(dp.__dict__)
+                dpattrs['archive'] = dp.archive or ""
+                dpattrs['hash'] = dp.hash or ""
                 dpattrs['comment'] = dpattrs['comment'].replace("<", "&lt;"). \
                     replace(">", "&gt;").replace('"', "''")
                 # if generating complete index, write empty anchor for each DP
@@ -489,7 +720,7 @@ class LogEntry(object):
                         dpattrs['relpath'] = relpath
                         dpattrs['basename'] = os.path.basename(dp.filename)
                         html += """
-            <A CLASS="DP" FILENAME="%(filename)s" SRC="%(sourcepath)s" POLICY="%(policy)s" QUIET=%(quiet)d TIMESTAMP=%(timestamp).6f RENDER="%(render)s" COMMENT="%(comment)s"></A>\n""" % dpattrs
+            <A CLASS="DP" FILENAME="%(filename)s" SRC="%(sourcepath)s" POLICY="%(policy)s" QUIET=%(quiet)d TIMESTAMP=%(timestamp).6f RENDER="%(render)s" ARCHIVE="%(archive)s" HASH="%(hash)s" COMMENT="%(comment)s"></A>\n""" % dpattrs
                 # render a table row
                 if not dp.ignored:
                     renderer = Purr.Render.makeRenderer(dp.render, dp, refresh=refresh)
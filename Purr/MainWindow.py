@@ -26,6 +26,7 @@ import Purr.Editors
 import Purr.LogEntry
 import Purr.Pipe
 import Purr.RenderIndex
+import Purr.RescanWorker
 from Purr import Config, pixmaps, dprint
 
 
@@ -420,6 +421,7 @@ class MainWindow(QMainWindow):
         self.etw.setRootIsDecorated(True)
         self.connect(self.etw, SIGNAL("itemSelectionChanged()"), self._entrySelectionChanged)
         self.connect(self.etw, SIGNAL("itemActivated(QTreeWidgetItem*,int)"), self._viewEntryItem)
+        self.connect(self.etw, SIGNAL("itemExpanded(QTreeWidgetItem*)"), self._expandEntryItem)
         self.connect(self.etw, SIGNAL("itemContextMenuRequested"), self._showItemContextMenu)
         # create popup menu for data products
         self._archived_dp_menu = menu = QMenu(self)
@@ -494,6 +496,10 @@ class MainWindow(QMainWindow):
         # create timer for pouncing
         self._timer = QTimer(self)
         self.connect(self._timer, SIGNAL("timeout()"), self._rescan)
+        # rescans are done by a worker thread, which reports back via the rescanFinished signal
+        self._rescan_worker = Purr.RescanWorker.RescanWorker(self)
+        self.connect(self._rescan_worker, SIGNAL("rescanFinished"), self._rescanFinished)
+        self._rescan_worker.start()
         # create dict mapping index.html paths to entry numbers
         self._index_paths = {}
 
@@ -509,6 +515,7 @@ class MainWindow(QMainWindow):
             self.hide()
             self.new_entry_dialog.hide()
         else:
+            self._rescan_worker.stop()
             if self.purrer:
                 self.purrer.detach()
             return QMainWindow.closeEvent(self, ev)
@@ -565,6 +572,8 @@ class MainWindow(QMainWindow):
                 # found? move to front of stack
                 self.purrer_stack.pop(i)
                 self.purrer_stack.insert(0, purrer)
+                # if it was put to sleep when we switched away from it, wake it up
+                purrer.wake()
                 # update purrer with watched directories, in case they have changed
                 for dd in (watchdirs or []):
                     purrer.addWatchedDirectory(dd, watching=None)
@@ -586,13 +595,19 @@ class MainWindow(QMainWindow):
                 os.path.abspath(purrlog), err.args[0]), QMessageBox.Ok, 0)
                 return False
             self.purrer_stack.insert(0, purrer)
-            # discard end of stack
-            self.purrer_stack = self.purrer_stack[:3]
+            # discard end of stack, releasing the locks of the purrers that fall off it
+            depth = max(Config.getint("purrer-stack-depth", 3), 1)
+            for dropped in self.purrer_stack[depth:]:
+                dprint(1, "dropping Purrer for", dropped.logdir, "from stack")
+                dropped.detach()
+            self.purrer_stack = self.purrer_stack[:depth]
             # attach signals
             self.connect(purrer, SIGNAL("disappearedFile"),
                          self.new_entry_dialog.dropDataProducts)
             self.connect(purrer, SIGNAL("disappearedFile"),
                          self.view_entry_dialog.dropDataProducts)
+            # if the purrer's watcher backend reports changes, rescan right away rather than waiting for the timer
+            self.connect(purrer, SIGNAL("watchedPathsChanged"), self._rescan)
         # have we changed the current purrer? Update our state then
         # reopen Purr pipes
         self.purrpipes = {}
@@ -626,6 +641,11 @@ class MainWindow(QMainWindow):
             # Reset _pounce to false -- this will cause checkPounceStatus() into a rescan
             self._pounce = False
             self._checkPounceStatus()
+            # inactive purrers on the stack don't need their entries and watchers until we switch back to them
+            if Config.getbool("hibernate-inactive", True):
+                for other in self.purrer_stack[1:]:
+                    other.hibernate()
+            dprint(2, "purrer stack:", self.purrerStackReport())
         return True
 
     def setLogTitle(self, title):
@@ -718,17 +738,11 @@ class MainWindow(QMainWindow):
     def _rescan(self, force=False):
         if not self.purrer:
             return
-        # if pounce is on, tell the Purrer to rescan directories
+        # if pounce is on, tell the worker thread to rescan directories. Results come back via _rescanFinished().
         if self._pounce or force:
-            dps = self.purrer.rescan()
-            if dps:
-                filenames = [dp.filename for dp in dps]
-                dprint(2, "new data products:", filenames)
-                self.message("Pounced on " + ", ".join(filenames))
-                if self.new_entry_dialog.addDataProducts(dps):
-                    dprint(2, "showing dialog")
-                    self.new_entry_dialog.show()
+            self._rescan_worker.requestRescan(self.purrer)
         # else read stuff from pipe
+        repoll = False
         for pipe in list(self.purrpipes.values()):
             do_show = False
             for command, show, content in pipe.read():
@@ -739,12 +753,42 @@ class MainWindow(QMainWindow):
                 elif command == "pounce":
                     self.new_entry_dialog.addDataProducts(self.purrer.makeDataProducts(
                         [(content, not show)], unbanish=True))
+                    # something is going on in there, so make sure the watchers get polled right away
+                    self.purrer.wakeWatchers(content)
+                    repoll = True
                 else:
                     print(("Unknown command received from Purr pipe: ", command))
                     continue
                 do_show = do_show or show
             if do_show:
                 self.new_entry_dialog.show()
+        if repoll and self._pounce:
+            QTimer.singleShot(0, self._rescan)
+
+    def _rescanFinished(self, purrer, dps):
+        """Called (via a queued signal from the worker thread) when a rescan is complete."""
+        dprint(3, "rescan stats:", self._rescan_worker.stats)
+        if not dps:
+            return
+        # results from a purrer that is no longer current are given back to it, for when it's current again
+        if purrer is not self.purrer:
+            purrer.requeueDataProducts(dps)
+            return
+        filenames = [dp.filename for dp in dps]
+        dprint(2, "new data products:", filenames)
+        self.message("Pounced on " + ", ".join(filenames))
+        if self.new_entry_dialog.addDataProducts(dps):
+            dprint(2, "showing dialog")
+            self.new_entry_dialog.show()
+
+    def rescanStats(self):
+        """Returns a Purr.RescanWorker.RescanStats object with timings of background rescans."""
+        return self._rescan_worker.stats
+
+    def purrerStackReport(self):
+        """Returns list of (logdir, report) pairs for the purrers on the stack, most recent first, where
+        report is the dict returned by Purrer.memoryReport()."""
+        return [(purrer.logdir, purrer.memoryReport()) for purrer in self.purrer_stack]
 
     def _addDPFiles(self, *files):
         """callback to add DPs corresponding to files."""
@@ -902,14 +946,30 @@ class MainWindow(QMainWindow):
         item._dp = None
         item._menu = self._entry_menu
         item._set_menu_title = lambda: self._entry_menu_title.setText('"%s"' % entry.title)
-        # now make subitems for DPs
+        # now make subitems for DPs. For entries that haven't been fully loaded, this is deferred until
+        # the item is expanded (see _expandEntryItem() below)
+        if entry.isLoaded():
+            self._addDPSubItems(entry, item)
+        else:
+            item.setChildIndicatorPolicy(QTreeWidgetItem.ShowIndicator)
+        self.etw.collapseItem(item)
+        self.etw.header().headerDataChanged(Qt.Horizontal, 0, 2)
+        return item
+
+    def _addDPSubItems(self, entry, item):
         subitem = None
         for dp in entry.dps:
             if not dp.ignored:
                 subitem = self._addDPSubItem(dp, item, subitem)
-        self.etw.collapseItem(item)
-        self.etw.header().headerDataChanged(Qt.Horizontal, 0, 2)
-        return item
+        item.setChildIndicatorPolicy(QTreeWidgetItem.DontShowIndicatorWhenChildless)
+
+    def _expandEntryItem(self, item):
+        """Called when an item is expanded. Makes DP subitems for entries that were loaded lazily."""
+        ientry = getattr(item, '_ientry', None)
+        if ientry is not None and not item.childCount() and \
+                item.childIndicatorPolicy() == QTreeWidgetItem.ShowIndicator:
+            busy = BusyIndicator()
+            self._addDPSubItems(self.purrer.entries[ientry], item)
 
     def _addDPSubItem(self, dp, parent, after):
         item = QTreeWidgetItem(parent, after)
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""Purr.Manifest maintains a machine-readable manifest of the entries in a purrlog.
+
+The manifest is a JSON-lines file (manifest.jsonl) in the purrlog directory. A record is appended every time
+an entry's index.html is written, so the latest record for an entry always describes its index.html,
+and earlier records for the same entry are superseded. Each record holds the entry's title, comment,
+timestamp and data products, plus the mtime of the index.html it was made from. When a purrlog is
+attached, entries whose index.html has not been modified since their record was written can be loaded from
+the manifest, without parsing any HTML.
+"""
+
+import json
+import os
+import os.path
+import traceback
+
+from Purr import dprintf
+
+MANIFEST = "manifest.jsonl"
+
+# manifest is rewritten (dropping superseded records) when it has this many times more lines than entries
+COMPACT_RATIO = 4
+
+
+def manifestFile(logdir):
+    return os.path.join(logdir, MANIFEST)
+
+
+def _dpRecord(dp):
+    # ignored DPs are not archived, so their index anchor only has the source, policy and comment. The
+    # record follows suit, so that the entry loads the same way from either.
+    if dp.ignored:
+        return dict(filename=None, sourcepath=dp.sourcepath, policy=dp.policy, quiet=False,
+                    timestamp=0, render=None, comment=dp.comment)
+    return dict(filename=dp.filename, sourcepath=dp.sourcepath, policy=dp.policy, quiet=bool(dp.quiet),
+                timestamp=dp.timestamp, render=dp.render, comment=dp.comment, archive=dp.archive,
+                hash=dp.hash)
+
+
+def makeRecord(entry):
+    """Returns manifest record (a dict) for a saved LogEntry."""
+    dps = [_dpRecord(dp) for dp in entry.dps]
+    return dict(entry=os.path.basename(entry.pathname), title=entry.title, comment=entry.comment,
+                timestamp=entry.timestamp, dps=dps, index_mtime=os.path.getmtime(entry.index_file))
+
+
+def addEntry(entry):
+    """Appends a record for the given LogEntry to the manifest of the purrlog it is saved in.
+    Errors are reported but otherwise ignored, since the manifest can always be rebuilt from the HTML."""
+    filename = manifestFile(os.path.dirname(entry.pathname))
+    try:
+        line = json.dumps(makeRecord(entry), separators=(',', ':')) + "\n"
+        with open(filename, 'a') as fobj:
+            fobj.write(line)
+        dprintf(3, "added %s to manifest\n", entry.pathname)
+    except:
+        print(("Error writing %s" % filename))
+        traceback.print_exc()
+
+
+def readManifest(logdir):
+    """Reads the manifest of the given purrlog. Returns dict of entry_name: record, with later records
+    superseding earlier ones. Malformed lines (e.g. one left half-written by a crash) are skipped.
+    Returns an empty dict if there is no manifest."""
+    filename = manifestFile(logdir)
+    records = {}
+    if not os.path.exists(filename):
+        return records
+    nlines = 0
+    try:
+        for line in open(filename):
+            nlines += 1
+            try:
+                record = json.loads(line)
+                records[record['entry']] = record
+            except (ValueError, KeyError, TypeError):
+                dprintf(1, "%s: skipping malformed line %d\n", filename, nlines)
+    except:
+        print(("Error reading %s" % filename))
+        traceback.print_exc()
+        return {}
+    dprintf(1, "read manifest %s: %d lines, %d entries\n", filename, nlines, len(records))
+    if nlines > COMPACT_RATIO * max(len(records), 16):
+        writeManifest(logdir, records)
+    return records
+
+
+def writeManifest(logdir, records):
+    """Writes out a complete manifest, given a dict of entry_name: record. The file is written under a
+    temporary name first, then renamed over the old manifest."""
+    filename = manifestFile(logdir)
+    tmpfile = filename + ".tmp"
+    try:
+        with open(tmpfile, 'w') as fobj:
+            for name in sorted(records.keys()):
+                fobj.write(json.dumps(records[name], separators=(',', ':')) + "\n")
+        os.rename(tmpfile, filename)
+        dprintf(1, "wrote manifest %s with %d entries\n", filename, len(records))
+    except:
+        print(("Error writing %s" % filename))
+        traceback.print_exc()
+
+
+def isCurrent(record, index_file):
+    """Returns True if the manifest record is up to date with respect to the entry's index.html, i.e.
+    the index has not been modified since the record was written."""
+    try:
+        return os.path.getmtime(index_file) <= record['index_mtime']
+    except (OSError, KeyError, TypeError):
+        return False
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""Purr.ObjectStore is an optional content-addressed store for archived data products.
+
+When enabled (with the dedup-store setting), files archived under the "copy" policy are stored once, under
+objects/XX/HASH in the purrlog, where HASH is the SHA-256 of their content. The file in the entry directory
+is then a hard link to the object, so the entry stays browsable as before, but a product that is archived
+again with the same content costs no extra space, and no copying. Objects are read-only. An object that
+is no longer linked from any entry (i.e. has a link count of 1) is garbage, and is removed by release().
+
+Hashing a large file is not cheap, so hashes are cached in an SQLite database (hashcache.db), keyed by path
+and validated against the file's device, inode, size and mtime. Comparing a file's size and hash with that of
+its last archived object also tells whether a file that has been touched has actually changed since.
+"""
+
+import errno
+import hashlib
+import os
+import os.path
+import sqlite3
+import stat
+import threading
+from typing import Dict
+
+import Purr.Archiver
+from Purr import Config, dprintf
+
+OBJECTS = "objects"
+HASHCACHE = "hashcache.db"
+
+# size of chunks in which files are read for hashing
+_HASH_CHUNK = 4 * 1024 * 1024
+
+
+class ObjectStore(object):
+    def __init__(self, logdir):
+        self.logdir = logdir
+        self.objdir = os.path.join(logdir, OBJECTS)
+        self.filename = os.path.join(logdir, HASHCACHE)
+        self._lock = threading.Lock()
+        # the cache is used from the GUI thread and from the rescan worker, see IgnoreList
+        self._db = sqlite3.connect(self.filename, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute("""CREATE TABLE IF NOT EXISTS hashes
+                                (path TEXT PRIMARY KEY, dev INTEGER, ino INTEGER, size INTEGER,
+                                 mtime INTEGER, hash TEXT)""")
+
+    def _cachedHash(self, path, st):
+        with self._lock:
+            if self._db is None:
+                return None
+            row = self._db.execute("SELECT dev, ino, size, mtime, hash FROM hashes WHERE path=?",
+                                   (path,)).fetchone()
+        if row and tuple(row[:4]) == (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns):
+            return row[4]
+        return None
+
+    def hashFile(self, path):
+        """Returns the SHA-256 (as a hex string) of the content of a file, using the cache if the file has not
+        changed since it was last hashed. Raises OSError if the file can't be read."""
+        st = os.stat(path)
+        digest = self._cachedHash(path, st)
+        if digest is not None:
+            return digest
+        sha = hashlib.sha256()
+        with open(path, 'rb') as fobj:
+            while True:
+                buf = fobj.read(_HASH_CHUNK)
+                if not buf:
+                    break
+                sha.update(buf)
+        digest = sha.hexdigest()
+        # if the file changed while we were reading it, the hash is not cached
+        if os.stat(path).st_mtime_ns == st.st_mtime_ns:
+            with self._lock:
+                if self._db is not None:
+                    with self._db:
+                        self._db.execute("INSERT OR REPLACE INTO hashes VALUES (?,?,?,?,?,?)",
+                                         (path, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, digest))
+        dprintf(3, "hashed %s: %s\n", path, digest)
+        return digest
+
+    def isUnchanged(self, path, digest):
+        """Returns True if the content of file 'path' still has the given hash."""
+        try:
+            return self.hashFile(path) == digest
+        except (OSError, IOError):
+            return False
+
+    def objectPath(self, digest):
+        return os.path.join(self.objdir, digest[:2], digest[2:])
+
+    def objectSize(self, digest):
+        """Returns the size of the object with the given hash. Raises OSError if there is no such object."""
+        return os.stat(self.objectPath(digest)).st_size
+
+    def archive(self, sourcepath, destpath):
+        """Archives file sourcepath to destpath through the store. Returns its hash.
+        The content is only copied into the store if no object with the same hash exists already. destpath is then
+        made a hard link to the object (or, if that fails, a copy of it)."""
+        digest = self.hashFile(sourcepath)
+        objpath = self.objectPath(digest)
+        if os.path.exists(objpath):
+            dprintf(2, "%s is already in the store as %s\n", sourcepath, digest)
+        else:
+            os.makedirs(os.path.dirname(objpath), exist_ok=True)
+            # the object is put in place by linking a temporary copy, so a failed copy never leaves a bad object
+            # behind, and if the same content is being stored concurrently (see LogEntry.save()), the first
+            # one in wins
+            tmppath = "%s.%d.tmp" % (objpath, threading.get_ident())
+            Purr.Archiver.archiveFile(sourcepath, tmppath, mode="reflink", update=False)
+            try:
+                os.chmod(tmppath, stat.S_IMODE(os.stat(tmppath).st_mode) & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+                os.link(tmppath, objpath)
+                dprintf(2, "stored %s as %s\n", sourcepath, digest)
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+            finally:
+                os.unlink(tmppath)
+        Purr.Archiver.remove(destpath)
+        try:
+            os.link(objpath, destpath)
+        except OSError as exc:
+            dprintf(2, "can't link %s to %s (%s), copying instead\n", destpath, objpath, exc)
+            Purr.Archiver.copyFile(objpath, destpath, update=False)
+        return digest
+
+    def release(self, digests):
+        """Removes the objects with the given hashes, if they are no longer linked from any entry."""
+        for digest in digests:
+            objpath = self.objectPath(digest)
+            try:
+                if os.stat(objpath).st_nlink == 1:
+                    os.unlink(objpath)
+                    dprintf(2, "removed unused object %s\n", digest)
+            except OSError:
+                pass
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+# open stores: dict of logdir: ObjectStore
+_stores = {}  # type: Dict[str, ObjectStore]
+_stores_lock = threading.Lock()
+
+
+def getStore(logdir):
+    """Returns the ObjectStore of the given purrlog, or None if the store is not enabled."""
+    if not Config.getbool("dedup-store", False):
+        return None
+    logdir = os.path.abspath(logdir)
+    with _stores_lock:
+        store = _stores.get(logdir)
+        if store is None:
+            store = _stores[logdir] = ObjectStore(logdir)
+        return store
+
+
+def closeStore(logdir):
+    """Closes the ObjectStore of the given purrlog, if one is open."""
+    with _stores_lock:
+        store = _stores.pop(os.path.abspath(logdir), None)
+    if store is not None:
+        store.close()
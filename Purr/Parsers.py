@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 _tdl_no_reimport = True
 
+import html
 import os.path
+import re
 import time
 from html.parser import HTMLParser
 
@@ -14,7 +16,120 @@ dprint = _verbosity.dprint
 dprintf = _verbosity.dprintf
 
 
+# Regular expressions for the fast path of LogIndexParser.parseFile().
+# These pick out anchor start tags and the closing HTML tag, which is all the parser reacts to outside of anchors
+_re_anchor_or_end = re.compile(r"<a(\s[^>]*)?>|</html\s*>", re.I)
+_re_anchor_close = re.compile(r"</a\s*>", re.I)
+_re_attr = re.compile(r"""\s*([a-zA-Z_][-.:a-zA-Z_0-9]*)(?:\s*=\s*("[^"]*"|'[^']*'|[^\s"'>]+))?""")
+_re_tag = re.compile(r"<(/?)([a-zA-Z][-.a-zA-Z0-9]*)[^>]*>")
+_re_line_chunk = re.compile(r"[^\n]*\n|[^\n]+")
+# things that HTMLParser treats specially, and which Purr does not write: comments, doctypes, CDATA and script/style
+# elements. If a file has any of these, the fast path is not used.
+_re_unexpected = re.compile(r"<!|<\?|<script|<style", re.I)
+
+
+class _Unexpected(Exception):
+    """Raised by the fast path when it finds something it is not sure to handle exactly like HTMLParser would."""
+    pass
+
+
+def _parse_attrs(attrstr):
+    """Parses attributes of a start tag the way HTMLParser does. Returns list of (name, value) pairs."""
+    attrs = []
+    pos = 0
+    attrstr = attrstr.rstrip()
+    while pos < len(attrstr):
+        match = _re_attr.match(attrstr, pos)
+        if not match or match.end() == pos:
+            raise _Unexpected("can't parse attributes: %s" % attrstr)
+        name, value = match.groups()
+        if value and value[0] in "'\"":
+            value = value[1:-1]
+        if value:
+            value = html.unescape(value)
+        attrs.append((name.lower(), value))
+        pos = match.end()
+    return attrs
+
+
 class LogIndexParser(HTMLParser):
+    def parseFile(self, filename, fields=None):
+        """Parses an index file. Purr writes its own index files, so a fast path is tried first: this picks
+        out the classed anchors with regular expressions, and feeds only these to the handlers below, exactly
+        as HTMLParser would have. If the fast path runs into anything unexpected, the whole file
+        is parsed by HTMLParser instead.
+        If 'fields' is given, it is a list of attribute names (e.g. "title", "timestamp"). The file is then only
+        read up to the point where all of these have been set."""
+        if fields:
+            for i, line in enumerate(open(filename)):
+                self.feed(line)
+                if not [field for field in fields if getattr(self, field, None) is None]:
+                    dprintf(4, "%s: found %s at line %d\n", filename, ",".join(fields), i)
+                    break
+            return
+        text = open(filename).read()
+        try:
+            self._parseFast(text)
+            return
+        except _Unexpected as exc:
+            dprintf(2, "%s: %s, using full parser\n", filename, exc)
+        self.reset()
+        for i, line in enumerate(text.splitlines(True)):
+            try:
+                self.feed(line)
+            except:
+                dprintf(0, "parse error at line %d of %s\n", i, filename)
+                raise
+
+    def _parseFast(self, text):
+        if _re_unexpected.search(text):
+            raise _Unexpected("unexpected markup")
+        pos = 0
+        while True:
+            match = _re_anchor_or_end.search(text, pos)
+            if not match:
+                return
+            pos = match.end()
+            tag = match.group(0)
+            if tag.endswith("/>"):
+                raise _Unexpected("unexpected anchor tag")
+            # end of document
+            if tag[1] == "/":
+                self.handle_endtag("html")
+                continue
+            self.handle_starttag("a", _parse_attrs(match.group(1) or ""))
+            # if the handler has started accumulating data, feed it the anchor's content
+            if self.curclass:
+                close = _re_anchor_close.search(text, pos)
+                if not close:
+                    raise _Unexpected("unclosed anchor")
+                self._feedContent(text[pos:close.start()])
+                self.handle_endtag("a")
+                pos = close.end()
+
+    def _feedContent(self, content):
+        """Feeds the content of an anchor to the handlers. Data is passed in the same chunks that HTMLParser
+        would produce when fed one line at a time: these are split at tags and at line ends."""
+        pos = 0
+        for match in list(_re_tag.finditer(content)) + [None]:
+            end = match.start() if match else len(content)
+            if end > pos:
+                for chunk in _re_line_chunk.findall(content[pos:end]):
+                    if "<" in chunk:
+                        raise _Unexpected("stray '<'")
+                    self.handle_data(html.unescape(chunk))
+            if match is None:
+                break
+            closing, name = match.groups()
+            name = name.lower()
+            if name in ("a", "html"):
+                raise _Unexpected("unexpected tag inside anchor")
+            if closing:
+                self.handle_endtag(name)
+            else:
+                self.handle_starttag(name, [])
+            pos = match.end()
+
     def reset(self):
         HTMLParser.reset(self)
         self.title = None
@@ -97,6 +212,18 @@ class LogIndexParser(HTMLParser):
             self.end()
 
 
+def parseLogHeader(filename):
+    """Reads the title and timestamp of a log from its index file, stopping as soon as these are found.
+    Returns (title, timestamp) tuple, or (None, None) on error."""
+    parser = LogIndexParser()
+    try:
+        parser.parseFile(filename, fields=("title", "timestamp"))
+    except:
+        dprintf(1, "error parsing %s\n", filename)
+        return None, None
+    return parser.title, parser.timestamp
+
+
 class LogEntryIndexParser(LogIndexParser):
     def __init__(self, dirname):
         LogIndexParser.__init__(self)
@@ -113,7 +240,7 @@ class LogEntryIndexParser(LogIndexParser):
         LogIndexParser.end(self)
 
     def _handle_start_DP(self, filename=None, src=None, policy=None, quiet=False,
-                         timestamp=0, comment=None, render=None, **kw):
+                         timestamp=0, comment=None, render=None, archive=None, hash=None, **kw):
         # dispence with previous DP tag, if any
         self._add_data_product()
         # setup data for this tag
@@ -131,7 +258,8 @@ class LogEntryIndexParser(LogIndexParser):
         self._new_dp = Purr.DataProduct(filename=filename, sourcepath=src,
                                         timestamp=timestamp, comment=comment,
                                         fullpath=os.path.join(self._dirname, filename or ""),
-                                        policy=policy, render=render, quiet=quiet, archived=True)
+                                        policy=policy, render=render, quiet=quiet, archived=True,
+                                        archive=archive or None, hash=hash or None)
 
     def _handle_end_TITLE(self, data):
         self.title = data.replace("&lt;", "<").replace("&gt;", ">")
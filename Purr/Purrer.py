@@ -8,25 +8,37 @@
 #   until the user presses the Purr button.
 # - think of including verbatim code snippets in HTML
 
+import concurrent.futures
 import configparser
 import fcntl
+import gzip
+import json
 import fnmatch
-import glob
+import functools
 import os
 import os.path
 import re
+import sys
+import threading
 import time
 import traceback
 from past.builtins import cmp
 
 import Kittens.utils
-from PyQt4.Qt import QObject, SIGNAL
+from PyQt4.Qt import QObject, QSocketNotifier, SIGNAL
 
 import Purr
+import Purr.Archiver
+import Purr.IgnoreList
+import Purr.Journal
+import Purr.Manifest
+import Purr.ObjectStore
 import Purr.Parsers
 import Purr.Plugins
 import Purr.Render
 import Purr.RenderIndex
+import Purr.WatchBackend
+import Purr.WatchService
 from Purr import Config, dprint, dprintf
 
 # this string is used to create lock files
@@ -64,24 +76,261 @@ def _printexc(message, *args):
 
 
 def matches_patterns(filename, patterns):
+    if isinstance(patterns, PatternSet):
+        return patterns.match(filename)
     return bool([patt for patt in patterns if fnmatch.fnmatch(filename, patt)])
 
 
+class PatternSet(object):
+    """A PatternSet is a set of filename patterns (as understood by fnmatch), compiled into a single
+    regular expression. Results of match() are memoized per filename, since the same basenames get
+    checked over and over again during rescans. The memo is bounded: it is simply flushed when it
+    grows beyond memo_size entries."""
+
+    memo_size = 20000
+
+    def __init__(self, patterns=()):
+        self.patterns = tuple(sorted(set(patterns)))
+        if self.patterns:
+            self._regex = re.compile("|".join(["(?:%s)" % fnmatch.translate(patt) for patt in self.patterns]))
+        else:
+            self._regex = None
+        self._memo = {}
+
+    @staticmethod
+    def make(patterns):
+        """Returns a PatternSet for 'patterns', which may be a PatternSet already, or an iterable of patterns."""
+        if isinstance(patterns, PatternSet):
+            return patterns
+        return PatternSet(patterns)
+
+    @staticmethod
+    def fromPatternList(patterns):
+        """Makes a PatternSet from a list of (description,[patterns]) tuples, as returned by parse_pattern_list()."""
+        allpatts = set()
+        for desc, patts in patterns:
+            allpatts.update(patts)
+        return PatternSet(allpatts)
+
+    def match(self, filename):
+        """Returns True if filename matches any of the patterns."""
+        result = self._memo.get(filename)
+        if result is None:
+            result = self._regex is not None and self._regex.match(os.path.normcase(filename)) is not None
+            if len(self._memo) >= self.memo_size:
+                self._memo.clear()
+            self._memo[filename] = result
+        return result
+
+    def filter(self, filenames):
+        """Returns list of filenames matching any of the patterns."""
+        return [fname for fname in filenames if self.match(fname)]
+
+    def __iter__(self):
+        return iter(self.patterns)
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def __repr__(self):
+        return "PatternSet(%s)" % ",".join(self.patterns)
+
+
+class PollScheduler(object):
+    """A PollScheduler decides when polled watchers are due to be checked. A watcher that has seen activity
+    (i.e. reported new files or changed its mtime) is polled again after min_interval seconds. Every
+    check that finds nothing doubles the interval, up to max_interval. Watchers can be woken up to force a
+    check on the next rescan."""
+
+    def __init__(self, min_interval=0, max_interval=60, backoff=2):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.backoff = backoff
+
+    def isDue(self, watcher, now):
+        return watcher.next_poll <= now
+
+    def update(self, watcher, active, now):
+        """Reschedules watcher after it has been polled. 'active' is True if the poll found something."""
+        if active:
+            watcher.poll_interval = self.min_interval
+        else:
+            watcher.poll_interval = min(max(watcher.poll_interval * self.backoff, 1), self.max_interval)
+        watcher.next_poll = now + watcher.poll_interval
+
+    def wake(self, watcher):
+        """Makes watcher due immediately, and resets its polling interval."""
+        watcher.poll_interval = self.min_interval
+        watcher.next_poll = 0
+
+
+def _locked(method):
+    """Decorator for Purrer methods that modify watcher state: the method is run while holding the purrer's lock,
+    so that it doesn't interfere with a rescan running in a worker thread."""
+
+    @functools.wraps(method)
+    def locked_method(self, *args, **kw):
+        with self._lock:
+            return method(self, *args, **kw)
+
+    return locked_method
+
+
+def _exclusive(method):
+    """Decorator for Purrer methods that tear down the watcher tables. Like _locked, but the method also waits for
+    a rescan to finish polling the watcher that it's on, so that it never sees a change that the watcher has consumed
+    but the rescan hasn't recorded yet."""
+
+    @functools.wraps(method)
+    def exclusive_method(self, *args, **kw):
+        with self._poll_lock, self._lock:
+            return method(self, *args, **kw)
+
+    return exclusive_method
+
+
+def _is_open_for_writing(path):
+    """Returns True if some process has 'path' open for writing. This looks through /proc/*/fd, so it only
+    works on Linux, and only sees processes that we're allowed to inspect (i.e. usually our own.)"""
+    try:
+        pids = [pid for pid in os.listdir("/proc") if pid.isdigit()]
+    except OSError:
+        return False
+    for pid in pids:
+        fddir = os.path.join("/proc", pid, "fd")
+        try:
+            fds = os.listdir(fddir)
+        except OSError:
+            continue
+        for fd in fds:
+            try:
+                if os.readlink(os.path.join(fddir, fd)) != path:
+                    continue
+                for line in open(os.path.join("/proc", pid, "fdinfo", fd)):
+                    if line.startswith("flags:"):
+                        if int(line.split()[1], 8) & (os.O_WRONLY | os.O_RDWR):
+                            return True
+                        break
+            except (OSError, ValueError):
+                continue
+    return False
+
+
+# Per-thread cache of os.stat() results. When Purrer.rescan() prefetches stats in parallel, it stores
+# them here (as a dict of path: stat result, or None on error) for the duration of the rescan.
+_stat_cache = threading.local()
+
+
+def _try_stat(path):
+    """Returns os.stat(path), or None on error."""
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+
+def _cached_stat(path):
+    """Returns os.stat(path), using results prefetched by the current thread if available. Returns None on error."""
+    cache = getattr(_stat_cache, 'stats', None)
+    if cache is not None and path in cache:
+        return cache[path]
+    return _try_stat(path)
+
+
+def _load_entry(pathname, record, lazy):
+    """Loads a LogEntry. This is a module-level function so that it can be run in a worker process."""
+    return Purr.LogEntry(load=pathname, record=record, lazy=lazy)
+
+
+def _entry_isdir(entry):
+    """Returns True if os.DirEntry refers to a directory (following symlinks), False on error."""
+    try:
+        return entry.is_dir()
+    except OSError:
+        return False
+
+
+def _entry_islink(entry):
+    """Returns True if os.DirEntry is a symlink, False on error."""
+    try:
+        return entry.is_symlink()
+    except OSError:
+        return False
+
+
 class Purrer(QObject):
+    _re_entry_dirname = re.compile(r"^entry-\d{8}-\d{6}$")
+
     @staticmethod
     def is_purrlog(path):
         """Checks if path refers to a valid purrlog.
         Path must exist, and must contain either at least one directory called entry-YYYYMMDD-HHMMSS, or the file "dirconfig"
+        (or a manifest). Returns as soon as one of these is found.
         """
         if not os.path.isdir(path):
             return False
-        if list(filter(os.path.isdir, glob.glob(
-                os.path.join(path, "entry-[0-9][0-9][0-9][0-9][0-9][0-9][0-9][0-9]-[0-9][0-9][0-9][0-9][0-9][0-9]")))):
-            return True
-        return os.path.exists(os.path.join(path, "dirconfig"))
+        # the marker files are cheapest to check for
+        for marker in "dirconfig", Purr.Manifest.MANIFEST:
+            if os.path.exists(os.path.join(path, marker)):
+                return True
+        # else look for the first entry directory
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if Purrer._re_entry_dirname.match(entry.name) and _entry_isdir(entry):
+                        return True
+        except OSError:
+            pass
+        return False
 
-    class WatchedFile(QObject):
-        """A WatchedFile represents a single file being watched for changes."""
+    @staticmethod
+    def find_purrlogs(dirname):
+        """Returns list of purrlogs found in directory 'dirname'. Hidden entries are skipped, as with glob("*")."""
+        purrlogs = []
+        try:
+            with os.scandir(dirname) as entries:
+                for entry in entries:
+                    if not entry.name.startswith(".") and _entry_isdir(entry) and Purrer.is_purrlog(entry.path):
+                        purrlogs.append(entry.path)
+        except OSError:
+            pass
+        return purrlogs
+
+    class SettlePolicy(object):
+        """Decides when a new or updated file has settled, i.e. its size and mtime have been stable for
+        settle_time seconds, and (if check_writers is set) no process has it open for writing. Each Purrer
+        has its own policy, which it passes to its watchers' newFiles()."""
+
+        def __init__(self, settle_time=0, check_writers=False):
+            self.settle_time = settle_time
+            self.check_writers = check_writers
+
+        def check(self, path, st, state, now):
+            """Checks if a file has settled. 'st' is the current os.stat() result for 'path', 'state' is the
+            (size, mtime, stable_since) tuple returned by the previous check, or None if this is the first one.
+            Returns None if the file has settled, else a new state tuple."""
+            key = (st.st_size, st.st_mtime)
+            if state is None or state[:2] != key:
+                # on first sight, the file has been stable since its mtime. If it has changed since the last
+                # check, it has only been stable since now.
+                since = min(st.st_mtime, now) if state is None else now
+                state = key + (since,)
+            if now - state[2] < self.settle_time:
+                return state
+            if self.check_writers and _is_open_for_writing(path):
+                dprintf(4, "%s is open for writing, waiting for it to settle\n", path)
+                return state
+            return None
+
+    class WatchedFile(object):
+        """A WatchedFile represents a single file being watched for changes.
+        If a SettlePolicy is passed to newFiles(), new or updated files are only reported once they have settled.
+        This keeps us from pouncing on files that are still being written.
+        There can be a great many of these (one per watched file and data product), so they are kept
+        small: no QObject, no per-instance __dict__, and paths are interned."""
+
+        __slots__ = ("path", "enabled", "quiet", "mtime", "survive_deletion", "disappeared", "event_driven",
+                     "pending", "poll_interval", "next_poll", "settling")
 
         def __init__(self, path, quiet=None, mtime=None, survive_deletion=False):
             """Creates watched file at 'path'. The 'quiet' flag is simply stored.
@@ -90,8 +339,7 @@ class Purrer(QObject):
             The survive_deletion flag is used to mark watchers that should stay active even if the underlying file
             disappears. Watchers for old data products are created with this flag.
             """
-            QObject.__init__(self)
-            self.path = path
+            self.path = sys.intern(path)
             self.enabled = True
             self.quiet = quiet
             dprintf(3, "creating WatchedFile %s, mtime %s (%f)\n", self.path,
@@ -99,6 +347,40 @@ class Purrer(QObject):
             self.mtime = mtime or self.getmtime()
             self.survive_deletion = survive_deletion
             self.disappeared = False
+            # True if changes to this file are reported by the Purrer's watcher backend, in which case
+            # the file is only polled when the backend says it has changed
+            self.event_driven = False
+            # True until the first check for updates, which always has to be done by polling
+            self.pending = True
+            # current polling interval and time of next poll, maintained by the Purrer's PollScheduler
+            self.poll_interval = 0
+            self.next_poll = 0
+            # (size, mtime, stable_since) tuple while an update is settling, else None
+            self.settling = None
+
+        def watchDir(self):
+            """Returns the directory that a watcher backend needs to watch in order to see changes to this file."""
+            return os.path.dirname(self.path)
+
+        def ownerDir(self):
+            """Returns the directory whose watching state governs this watcher, i.e. the directory that the
+            files reported by newFiles() live in."""
+            return os.path.dirname(self.path)
+
+        def hasPending(self):
+            """Returns True if the watcher has something to report regardless of any filesystem changes,
+            i.e. it needs to be polled on the next rescan."""
+            return self.pending or self.settling is not None
+
+        def snapshot(self):
+            """Returns the watcher's state as a dict that can be stored as JSON and passed back to the
+            constructor on the next attach."""
+            return dict(mtime=self.mtime)
+
+        def snapshotDelta(self, fileset0):
+            """Returns the watcher's state for the event journal, given the directory listing it had before
+            the latest newFiles() call. For a file, this is simply its snapshot()."""
+            return self.snapshot()
 
         def getmtime(self):
             """Returns the file's modification time.
@@ -108,31 +390,54 @@ class Purrer(QObject):
             except:
                 return None
 
-        def isUpdated(self):
+        def getstat(self):
+            """Returns os.stat() result for the file, or None on access error."""
+            return _cached_stat(self.path)
+
+        def statPaths(self):
+            """Returns list of paths that newFiles() will stat, so that these can be prefetched."""
+            return [self.path]
+
+        def isUpdated(self, settle=None):
             """Checks if file was updated (i.e. mtime changed) since last check. Returns True if so.
+            If 'settle' is a SettlePolicy, an update is only reported once the file has settled.
             Returns None on access error."""
             if not self.enabled:
                 return None
-            mtime = self.getmtime()
-            if mtime is None:
+            self.pending = False
+            st = self.getstat()
+            if st is None:
+                self.settling = None
                 return None
+            mtime = st.st_mtime
             # clear disappeared flag
             self.disappeared = False
-            # compare m,times -- add .1 sec margin since float numbers may get clobbered during
-            # conversion
-            updated = (mtime or 0) > (self.mtime or 0) + .1
-            if updated:
-                dprintf(4, "WatchedFile %s is updated: mtime %f %s, old mtime %f %s\n", self.path,
-                        mtime, time.strftime("%x %X", time.localtime(mtime)),
-                        self.mtime, time.strftime("%x %X", time.localtime(self.mtime)))
+            if self.settling is None:
+                # compare m,times -- add .1 sec margin since float numbers may get clobbered during
+                # conversion
+                updated = (mtime or 0) > (self.mtime or 0) + .1
+                if updated:
+                    dprintf(4, "WatchedFile %s is updated: mtime %f %s, old mtime %f %s\n", self.path,
+                            mtime, time.strftime("%x %X", time.localtime(mtime)),
+                            self.mtime, time.strftime("%x %X", time.localtime(self.mtime)))
+            else:
+                updated = True
+            # updated file needs to settle before we report it. Until then, keep the old mtime, so
+            # that the update is not lost if we are restarted in the meantime.
+            if updated and settle is not None:
+                self.settling = settle.check(self.path, st, self.settling, time.time())
+                if self.settling is not None:
+                    dprintf(4, "WatchedFile %s is settling\n", self.path)
+                    return False
             self.mtime = mtime
             return updated
 
-        def newFiles(self):
+        def newFiles(self, settle=None):
             """Checks if there are any new files, returns iterable of (full) paths.
             (For a single file, this is just the file itself, if it has been updated.)
+            'settle' is the SettlePolicy for new and updated files, or None to report them immediately.
             Returns None on access error."""
-            updated = self.isUpdated()
+            updated = self.isUpdated(settle)
             if updated is None:
                 return None
             return (updated and [self.path]) or []
@@ -141,51 +446,122 @@ class Purrer(QObject):
         """A WatchedDir represents a directory being watched for new files.
         """
 
-        def __init__(self, path, watch_patterns=[], ignore_patterns=[], **kw):
+        __slots__ = ("watch_patterns", "ignore_patterns", "_newfiles", "_settling",
+                     "fileset", "fileset_mtime", "subdirs", "symlinks")
+
+        def __init__(self, path, watch_patterns=[], ignore_patterns=[], snapshot=None, **kw):
             """Initializes directory.
             'ignore_patterns' is a list of patterns to be ignored.
             'watch_patterns' is a list of patterns to be watched.
             New files will be reported only if they don't match any of the ignore patterns, or
             match a watch pattern.
+            'snapshot' is a dict returned by snapshot() during a previous session. If supplied, the
+            directory content is compared to the snapshot instead of checking creation times of all files,
+            and if the directory has not been modified since, it is not read at all.
             All other arguments as per WatchedFile
             """
+            if snapshot:
+                kw['mtime'] = snapshot.get('mtime') or kw.get('mtime')
             Purrer.WatchedFile.__init__(self, path, **kw)
-            self.watch_patterns = watch_patterns
-            self.ignore_patterns = ignore_patterns
+            self.watch_patterns = watch_patterns = PatternSet.make(watch_patterns)
+            self.ignore_patterns = ignore_patterns = PatternSet.make(ignore_patterns)
             self._newfiles = []
-            # the self.fileset attribute gives the current directory content
+            # new files that are waiting to settle: dict of name: (size, mtime, stable_since)
+            self._settling = {}
+            dir_mtime = self.getmtime()
+            # if the snapshot was taken at the current directory mtime, directory content is unchanged
+            if snapshot and dir_mtime is not None and snapshot.get('fileset_mtime') == dir_mtime:
+                dprintf(3, "%s unchanged since snapshot, not rescanning\n", self.path)
+                self.fileset = set(snapshot.get('fileset', []))
+                self.subdirs = set(snapshot.get('subdirs', []))
+                self.symlinks = set(snapshot.get('symlinks', []))
+                self.fileset_mtime = dir_mtime
+                self._newfiles = list(snapshot.get('newfiles', []))
+                return
+            # the self.fileset attribute gives the current directory content.
+            # The directory is read in a single os.scandir() pass. The entry type information returned by
+            # the scan is used to populate self.subdirs (names of subdirectories) and self.symlinks (names
+            # of symbolic links), so that callers don't need to stat the entries again. Entries are only
+            # stat'ed when the directory has been modified since self.mtime, and then at most once.
             try:
-                self.fileset = set(os.listdir(self.path))
+                with os.scandir(self.path) as scan:
+                    entries = list(scan)
             except:
-                _printexc("Error doing listdir(%s)" % self.path)
-                traceback.print_exc()
+                _printexc("Error doing scandir(%s)" % self.path)
                 self.fileset = None;  # this indicates a read error
+                self.subdirs = self.symlinks = frozenset()
                 return
-            # check for files created after the supplied timestamp
-            if self.getmtime() > self.mtime:
+            self.fileset = set([entry.name for entry in entries])
+            self.subdirs = set([entry.name for entry in entries if _entry_isdir(entry)])
+            self.symlinks = set([entry.name for entry in entries if _entry_islink(entry)])
+            # this is the directory mtime corresponding to the current fileset
+            self.fileset_mtime = dir_mtime
+            # if we have a snapshot, new files are simply the ones not in it
+            if snapshot:
+                self._newfiles = list(snapshot.get('newfiles', []))
+                for fname in self.fileset.difference(snapshot.get('fileset', [])):
+                    if ignore_patterns.match(fname) and not watch_patterns.match(fname):
+                        continue
+                    dprintf(4, "%s: new file since snapshot\n", fname)
+                    self._newfiles.append(fname)
+            # else check for files created after the supplied timestamp
+            elif dir_mtime is not None and dir_mtime > self.mtime:
                 dprintf(2, "%s modified since last run (%f vs %f), checking for new files\n", self.path,
-                        self.getmtime(), self.mtime)
-                for fname in self.fileset:
+                        dir_mtime, self.mtime)
+                for entry in entries:
+                    fname = entry.name
                     # ignore files from ignore list
-                    if matches_patterns(fname, ignore_patterns) and not matches_patterns(fname, watch_patterns):
+                    if ignore_patterns.match(fname) and not watch_patterns.match(fname):
                         dprintf(5, "%s: matches ignore list but not watch list, skipping\n", fname)
                         continue
-                    fullname = os.path.join(self.path, fname)
-                    # check creation time against our timestamp
+                    # check creation time against our timestamp. DirEntry.stat() caches its result, and
+                    # shares it with is_dir() above, so this is at most one stat() per entry.
                     try:
-                        ctime = os.path.getctime(fullname)
+                        ctime = entry.stat().st_ctime
                     except:
                         _printexc("Error getting ctime for %s, ignoring", fname)
                         continue
                     if ctime > self.mtime:
-                        dprintf(4, "%s: new file (created %s)\n", fullname,
+                        dprintf(4, "%s: new file (created %s)\n", entry.path,
                                 time.strftime("%x %X", time.localtime(ctime)))
                         # append basename to _newfiles: full path added in newFiles() below
                         self._newfiles.append(fname)
 
-        def newFiles(self):
+        def entryPath(self, fname):
+            """Returns the canonical path of the directory entry 'fname'. The directory path itself is
+            canonical, so only entries that were found to be symlinks need to be resolved."""
+            fullname = os.path.join(self.path, fname)
+            if fname in self.symlinks:
+                return Purr.canonizePath(fullname)
+            return fullname
+
+        def watchDir(self):
+            return self.path
+
+        def ownerDir(self):
+            return self.path
+
+        def hasPending(self):
+            return self.pending or bool(self._newfiles) or bool(self._settling)
+
+        def snapshot(self):
+            return dict(mtime=self.mtime, fileset_mtime=self.fileset_mtime,
+                        fileset=sorted(self.fileset), subdirs=sorted(self.subdirs), symlinks=sorted(self.symlinks),
+                        newfiles=list(self._newfiles) + list(self._settling.keys()))
+
+        def snapshotDelta(self, fileset0):
+            """Returns the change in the watcher's state since its listing was 'fileset0', for the event journal.
+            This is the snapshot, except that instead of the full listing, only the names added to it and
+            removed from it are given. See Purrer._applySnapshotDelta()."""
+            return dict(mtime=self.mtime, fileset_mtime=self.fileset_mtime,
+                        added=sorted(self.fileset.difference(fileset0)),
+                        removed=sorted(fileset0.difference(self.fileset)),
+                        newfiles=list(self._newfiles) + list(self._settling.keys()))
+
+        def newFiles(self, settle=None):
             """Returns new files (since last call to newFiles, or since creation).
             Return value is an iterable of (full) paths.
+            'settle' is the SettlePolicy for new files, or None to report them immediately.
             Returns None on access error."""
             if not self.enabled:
                 return None
@@ -193,12 +569,16 @@ class Purrer(QObject):
                 return None
             newfiles = set(self._newfiles);  # some newfiles may have been found in __init__
             self._newfiles = []
+            # files that were still settling last time around are checked again
+            newfiles.update(self._settling.keys())
+            # the directory itself doesn't need to settle, new files in it do (see below)
             updated = self.isUpdated()
             if updated is None:
                 return None
             elif updated:
+                # the listing may be shared with other purrers watching the same directory
                 try:
-                    fileset1 = set(os.listdir(self.path))
+                    fileset1 = Purr.WatchService.listdir(self.path, self.mtime)
                 except:
                     _printexc("Error doing listdir(%s)" % self.path)
                     traceback.print_exc()
@@ -206,13 +586,28 @@ class Purrer(QObject):
                     return None
                 newfiles.update(fileset1.difference(self.fileset))
                 self.fileset = fileset1
+                self.fileset_mtime = self.mtime
             # skip new files in ignore list
             # also skip new files with older timestamps -- these may have been restored from the archive
             nfs = []
+            now = time.time()
             for file in newfiles:
-                if matches_patterns(file, self.ignore_patterns) and not matches_patterns(file, self.watch_patterns):
+                if self.ignore_patterns.match(file) and not self.watch_patterns.match(file):
                     continue
                 path = os.path.join(self.path, file)
+                # hold back files that haven't settled yet. Files that have vanished are dropped.
+                if settle is not None:
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        self._settling.pop(file, None)
+                        continue
+                    state = settle.check(path, st, self._settling.get(file), now)
+                    if state is not None:
+                        dprintf(4, "new file %s is settling\n", path)
+                        self._settling[file] = state
+                        continue
+                    self._settling.pop(file, None)
                 # try:
                 #  mtime = os.path.getmtime(path)
                 # except:
@@ -230,20 +625,46 @@ class Purrer(QObject):
         is reported as a "new file" if the directory mtime changes, or a canary has changed.
         """
 
-        def __init__(self, path, canary_patterns=[], **kw):
-            Purrer.WatchedDir.__init__(self, path, **kw)
-            self.canary_patterns = canary_patterns
+        __slots__ = ("canary_patterns", "canaries")
+
+        def __init__(self, path, canary_patterns=[], snapshot=None, **kw):
+            Purrer.WatchedDir.__init__(self, path, snapshot=snapshot, **kw)
+            self.canary_patterns = canary_patterns = PatternSet.make(canary_patterns)
             self.canaries = {}
+            # canary timestamps from snapshot, if any
+            canary_mtimes = (snapshot and snapshot.get('canaries')) or {}
             # if no read errors, make up list of canaries from canary patterns
             if self.fileset is not None:
                 for fname in self.fileset:
-                    if matches_patterns(fname, canary_patterns):
+                    if canary_patterns.match(fname):
                         fullname = os.path.join(self.path, fname)
-                        self.canaries[fullname] = Purrer.WatchedFile(fullname, mtime=self.mtime)
+                        self.canaries[fullname] = Purrer.WatchedFile(fullname,
+                                                                     mtime=canary_mtimes.get(fullname) or self.mtime)
                         dprintf(3, "watching canary file %s, timestamp %s\n",
                                 fullname, time.strftime("%x %X", time.localtime(self.mtime)))
 
-        def newFiles(self):
+        def ownerDir(self):
+            # a subdirectory reports itself as the new file, so it is governed by its parent directory
+            return os.path.dirname(self.path)
+
+        def statPaths(self):
+            return [self.path] + list(self.canaries.keys())
+
+        def hasPending(self):
+            return Purrer.WatchedDir.hasPending(self) or \
+                bool([watcher for watcher in self.canaries.values() if watcher.settling is not None])
+
+        def snapshot(self):
+            state = Purrer.WatchedDir.snapshot(self)
+            state['canaries'] = dict([(path, watcher.mtime) for path, watcher in self.canaries.items()])
+            return state
+
+        def snapshotDelta(self, fileset0):
+            state = Purrer.WatchedDir.snapshotDelta(self, fileset0)
+            state['canaries'] = dict([(path, watcher.mtime) for path, watcher in self.canaries.items()])
+            return state
+
+        def newFiles(self, settle=None):
             """Returns new files (since last call to newFiles, or since creation).
             The only possible new file is the subdirectory itself, which is considered
             new if updated, or if a canary has changed.
@@ -252,7 +673,7 @@ class Purrer(QObject):
             if self.fileset is None:
                 return None
             # check for new files first
-            newfiles = Purrer.WatchedDir.newFiles(self)
+            newfiles = Purrer.WatchedDir.newFiles(self, settle)
             if newfiles is None:
                 return None
             # this timestamp is assigned to all canaries when directory has changed
@@ -262,14 +683,14 @@ class Purrer(QObject):
             if newfiles:
                 dprintf(3, "directory %s is updated\n", self.path)
                 for fname in newfiles:
-                    if matches_patterns(os.path.basename(fname), self.canary_patterns):
+                    if self.canary_patterns.match(os.path.basename(fname)):
                         self.canaries[fname] = Purrer.WatchedFile(fname, mtime=timestamp)
                         dprintf(3, "watching new canary file %s, timestamp %s\n",
                                 fname, time.strftime("%x %X", time.localtime(timestamp)))
             # else check current canaries for updates
             else:
                 for filename, watcher in list(self.canaries.items()):
-                    updated = watcher.isUpdated()
+                    updated = watcher.isUpdated(settle)
                     if updated is None:
                         dprintf(2, "access error on canary %s, will no longer be watched", filename)
                         del self.canaries[filename]
@@ -287,28 +708,29 @@ class Purrer(QObject):
 
     def __init__(self, purrlog, watchdirs=None):
         QObject.__init__(self)
+        # this lock protects the watcher tables, since rescan() may be called from a worker thread
+        self._lock = threading.RLock()
+        # held by rescan() while it polls a watcher and records what it found, see _exclusive()
+        self._poll_lock = threading.Lock()
+        # bumped whenever the watcher tables are torn down (on attach, hibernate and detach), so that a rescan
+        # running in a worker thread can tell that its results are stale
+        self._generation = 0
         # load and parse configuration
         # watched files
         watch = Config.get("watch-patterns", "Images=*fits,*FITS,*jpg,*png;TDL configuration=.tdl.conf")
         self._watch = parse_pattern_list(watch)
-        self._watch_patterns = set()
-        for desc, patts in self._watch:
-            self._watch_patterns.update(patts)
+        self._watch_patterns = PatternSet.fromPatternList(self._watch)
         dprint(1, "watching patterns", self._watch_patterns)
         # quietly watched files (dialog is not popped up)
         watch = Config.get("watch-patterns-quiet", "TDL configuration=.tdl.conf")
         self._quiet = parse_pattern_list(watch)
-        self._quiet_patterns = set()
-        for desc, patts in self._quiet:
-            self._quiet_patterns.update(patts)
+        self._quiet_patterns = PatternSet.fromPatternList(self._quiet)
         dprint(1, "quietly watching patterns", self._quiet_patterns)
         # ignored files
         ignore = Config.get("ignore-patterns",
                             "Hidden files=.*;Purr logs=*purrlog;MeqTree logs=meqtree.log;Python files=*.py*;Backup files=*~,*.bck;Measurement sets=*.MS,*.ms;CASA tables=table.f*,table.dat,table.info,table.lock")
         self._ignore = parse_pattern_list(ignore)
-        self._ignore_patterns = set()
-        for desc, patts in self._ignore:
-            self._ignore_patterns.update(patts)
+        self._ignore_patterns = PatternSet.fromPatternList(self._ignore)
         dprint(1, "ignoring patterns", self._ignore_patterns)
         # watched subdirectories
         subdirs = Config.get("watch-subdirs", "MEP tables=*mep/funklets,table.dat")
@@ -320,19 +742,71 @@ class Purrer(QObject):
                 desc = match.group(1)
                 dir_patt = match.group(2).split(',')
                 canary_patt = match.group(3).split(',')
-                self._subdir_patterns.append((desc, dir_patt, canary_patt))
+                self._subdir_patterns.append((desc, PatternSet(dir_patt), PatternSet(canary_patt)))
         dprint(1, "watching subdirectories", self._subdir_patterns)
+        # archive modes for the "copy" policy, given as mode=patterns (see Purr.Archiver.ARCHIVE_MODES).
+        # The first matching mode applies, files matching none are copied normally.
+        modes = Config.get("archive-modes", "reflink=*fits,*FITS")
+        self._archive_modes = [(mode, PatternSet(patts)) for mode, patts in parse_pattern_list(modes)
+                               if mode in Purr.Archiver.ARCHIVE_MODES]
+        dprint(1, "archive modes", self._archive_modes)
+        # settle window for new and updated files, 0 to report them immediately
+        settle_time = float(Config.get("settle-time", 0))
+        check_writers = Config.getbool("settle-check-writers", False)
+        self._settle = Purrer.SettlePolicy(settle_time, check_writers) if settle_time > 0 else None
+        dprint(1, "settle time", settle_time, "check writers", check_writers)
         # attach to directories
         self.attached = False;  # will be True when we successfully attach
         self.other_lock = None;  # will be not None if another PURR holds a lock on this directory
         self.lockfile_fd = None
         self.lockfile_fobj = None
+        self.ignorelist = None
+        self.journal = None
+        self.store = None
+        # polling scheduler. Directories and files that see no activity are polled progressively less often,
+        # up to the poll-interval-max setting (in seconds).
+        self._scheduler = PollScheduler(Config.getint("poll-interval-min", 0), Config.getint("poll-interval-max", 60))
+        # watchers that get change events from the backend are still polled every event-poll-interval seconds,
+        # since events can be missed (e.g. inotify doesn't see writes made by other hosts on NFS or Lustre)
+        event_interval = Config.getint("event-poll-interval", 300)
+        self._event_scheduler = PollScheduler(event_interval, event_interval)
+        # thread pool for stat()ing watched files in parallel during rescans. This only pays off on
+        # high-latency filesystems (NFS, Lustre and such), so is off by default.
+        nthreads = Config.getint("rescan-threads", 0)
+        self._stat_pool = concurrent.futures.ThreadPoolExecutor(nthreads) if nthreads > 0 else None
+        dprint(1, "rescan threads", nthreads)
+        # worker thread for checking the content hashes of touched data products (see _checkArchivedHashes()),
+        # started on first use
+        self._hash_pool = None
+        # watcher backend, replaced by a proper one in _attach()
+        self._backend = Purr.WatchBackend.PollingBackend()
+        self._notifier = None
+        self._service = None
         self._attach(purrlog, watchdirs)
 
     def __del__(self):
         self.detach()
 
+    @_exclusive
     def detach(self):
+        if self.attached:
+            self._writeSnapshot()
+        self._generation += 1
+        self._closeBackend()
+        if self.ignorelist is not None:
+            self.ignorelist.close()
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if self.store is not None:
+            Purr.ObjectStore.closeStore(self.logdir)
+            self.store = None
+        if self._stat_pool is not None:
+            self._stat_pool.shutdown(wait=False)
+            self._stat_pool = None
+        if self._hash_pool is not None:
+            self._hash_pool.shutdown(wait=False)
+            self._hash_pool = None
         if self.lockfile_fobj:
             try:
                 self.lockfile_fobj.close()
@@ -365,15 +839,12 @@ class Purrer(QObject):
         self.timestamp = self.last_scan_timestamp = time.time()
         self._initIndexDir()
         # reset internal state
-        self.ignorelistfile = None
+        self.ignorelist = None
+        self.journal = None
+        self.store = None
         self.autopounce = False
-        self.watched_dirs = []
-        self.entries = []
-        self._default_dp_props = {}
-        self.watchers = {}
-        self.temp_watchers = {}
-        self.attached = False
-        self._watching_state = {}
+        self.hibernating = False
+        self._resetTables()
         # check that we hold a lock on the directory
         self.lockfile = os.path.join(self.logdir, ".purrlock")
         # try to open lock file for r/w
@@ -398,14 +869,91 @@ class Purrer(QObject):
         except:
             raise
         #      raise Purrer.LockFailError("cannot write to lock file %s"%self.lockfile)
+        # open store of ignored files
+        try:
+            self.ignorelist = Purr.IgnoreList.IgnoreList(self.logdir)
+        except:
+            _printexc("Error opening ignorelist in %s, ignored files will not be remembered", self.logdir)
+        # open event journal
+        if Config.getbool("use-journal", True):
+            try:
+                self.journal = Purr.Journal.Journal(self.logdir)
+            except:
+                _printexc("Error opening journal in %s, crash recovery will not be available", self.logdir)
+        # open object store, if enabled
+        try:
+            self.store = Purr.ObjectStore.getStore(self.logdir)
+        except:
+            _printexc("Error opening object store in %s, data products will not be deduplicated", self.logdir)
+        self.snapshotfile = os.path.join(self.logdir, "watchstate.gz")
+        self._load(watchdirs)
+        return True
+
+    def _resetTables(self):
+        """Clears log entries, watchers and related state."""
+        self._generation += 1
+        self.watched_dirs = []
+        self.entries = []
+        self._default_dp_props = {}
+        # content hashes of the last archived versions of data products, for those archived via the object store
+        self._archived_hashes = {}
+        # watchers whose full state is in the snapshot or the journal, so that the journal only needs to record
+        # changes to their directory listings (see rescan())
+        self._journal_bases = set()
+        # hash checks in progress: dict of path: (future, quiet flag)
+        self._hash_checks = {}
+        # new files that have been found, but not yet handed out by rescan(): dict of path: quiet flag. These are
+        # kept in the watcher snapshot, so that they are reported again after hibernation or a restart.
+        self._undelivered = {}
+        self.watchers = {}
+        self.temp_watchers = {}
+        self.attached = False
+        self._watching_state = {}
+        # index of self.watchers by directory: dict of dirname: {path: watcher}. Watchers that must always be
+        # polled (i.e. those of old data products) are indexed under None.
+        self._dir_index = {}
+        # set of directories that have been re-enabled, and whose watchers need to catch up on the next rescan
+        self._resync_dirs = set()
+        # watcher snapshot from previous session, used while attaching
+        self._snapshot = {}
+
+    def _closeBackend(self):
+        if self._notifier:
+            self._notifier.setEnabled(False)
+            self._notifier = None
+        if self._service is not None:
+            self.disconnect(self._service, SIGNAL("pathsChanged"), self._processSharedEvents)
+            self._service = None
+        self._backend.close()
+
+    def _load(self, watchdirs=None):
+        """Loads log entries and sets up watchers. Called once the lock on the purrlog has been acquired,
+        and again when waking up from hibernation."""
+        # load watcher snapshot left behind by the previous session, and bring it up to date with the journal
+        # (which will only have anything in it if the previous session did not detach cleanly)
+        snapshot_time, self._snapshot, pending = self._readSnapshot()
+        self._replayJournal(snapshot_time)
+        # setup watcher backend. If it provides a file descriptor, we get notified of changes through it,
+        # and emit a watchedPathsChanged signal so that a rescan can be done without waiting for the next poll.
+        # By default, the backend is shared with the other purrers in this process, via the watch service,
+        # which then does the listening for us.
+        if Config.getbool("share-watchers", True):
+            self._service = Purr.WatchService.getService(Config.getbool("use-inotify", True))
+            self._backend = self._service.subscribe()
+            self.connect(self._service, SIGNAL("pathsChanged"), self._processSharedEvents)
+        else:
+            self._backend = Purr.WatchBackend.makeBackend(Config.getbool("use-inotify", True))
+        if self._backend.fileno() is not None:
+            self._notifier = QSocketNotifier(self._backend.fileno(), QSocketNotifier.Read, self)
+            self.connect(self._notifier, SIGNAL("activated(int)"), self._processBackendEvents)
         # load log state if log directory already exists
         if os.path.exists(self.logdir):
             _busy = Purr.BusyIndicator()
             if os.path.exists(self.indexfile):
                 try:
+                    # only the title and timestamp are needed here, so stop reading once we have them
                     parser = Purr.Parsers.LogIndexParser()
-                    for line in open(self.indexfile):
-                        parser.feed(line)
+                    parser.parseFile(self.indexfile, fields=("title", "timestamp"))
                     self.logtitle = parser.title or self.logtitle
                     self.timestamp = parser.timestamp or self.timestamp
                     dprintf(2, "attached log '%s', timestamp %s\n",
@@ -413,21 +961,18 @@ class Purrer(QObject):
                 except:
                     traceback.print_exc()
                     print(("Error parsing %s, reverting to defaults" % self.indexfile))
-            # load log entries
-            entries = []
+            # load log entries. Entries with an up-to-date record in the manifest are loaded from it,
+            # the rest are parsed from their index.html files. In lazy mode, entries loaded from the manifest
+            # only set up their data products once something asks for them.
+            manifest = Purr.Manifest.readManifest(self.logdir)
+            lazy = Config.getbool("lazy-load-entries", True)
+            fnames = []
             for fname in os.listdir(self.logdir):
-                pathname = os.path.join(self.logdir, fname)
-                if Purr.LogEntry.isValidPathname(pathname):
-                    try:
-                        entry = Purr.LogEntry(load=pathname)
-                        dprint(2, "loaded log entry", pathname)
-                    except:
-                        print(("Error loading entry %s, skipping" % fname))
-                        traceback.print_exc()
-                        continue
-                    entries.append(entry)
+                if Purr.LogEntry.isValidPathname(os.path.join(self.logdir, fname)):
+                    fnames.append(fname)
                 else:
                     dprint(2, fname, "is not a valid Purr entry")
+            entries = self._loadEntries(fnames, manifest, lazy)
             # sort log entires by timestamp
             import six
             if six.PY2:
@@ -464,47 +1009,132 @@ class Purrer(QObject):
         # start watching the specified directories
         for name in (watchdirs or []):
             self.addWatchedDirectory(name, watching=None)
-        # Finally, go through list of ignored files and mark their watchers accordingly.
-        # The ignorelist is a list of lines of the form "timestamp filename", giving the timestamp when a
-        # file was last "ignored" by the purrlog user.
-        self.ignorelistfile = os.path.join(self.logdir, "ignorelist")
-        if os.path.exists(self.ignorelistfile):
-            # read lines from file, ignore exceptions
-            ignores = {}
-            try:
-                for line in open(self.ignorelistfile).readlines():
-                    timestamp, policy, filename = line.strip().split(" ", 2)
-                    # update dictiornary with latest timestamp
-                    ignores[filename] = int(timestamp), policy
-            except:
-                print(("Error reading %s" % self.ignorelistfile))
-                traceback.print_exc()
-            # now scan all listed files, and make sure their watchers' mtime is no older than the given
-            # last-ignore-timestamp. This ensures that we don't pounce on these files after restarting purr.
-            for filename, (timestamp, policy) in list(ignores.items()):
-                watcher = self.watchers.get(filename, None)
-                if watcher:
-                    watcher.mtime = max(watcher.mtime, timestamp)
+        # Watchers in watched directories have been checked against the ignorelist by addWatchedDirectory().
+        # Check the remaining ones (i.e. those made for data products of old entries) too.
+        for path, watcher in self._dir_index.get(None, {}).items():
+            self._applyIgnoreTimestamp(path, watcher)
+        # Watchers of files (e.g. those made for data products of old entries) have not used the snapshot
+        # so far. Bring their timestamps up to date, so that we don't pounce on changes that were already seen.
+        for path, state in self._snapshot.items():
+            watcher = self.watchers.get(path)
+            if watcher is not None and type(watcher) is Purrer.WatchedFile and state.get('mtime'):
+                watcher.mtime = max(watcher.mtime, state['mtime'])
+            # a directory watcher that took its listing from the snapshot (or journal) as is can have its
+            # changes journaled as deltas against it
+            elif getattr(watcher, 'fileset', None) is not None and 'fileset' in state and \
+                    watcher.fileset_mtime == state.get('fileset_mtime'):
+                self._journal_bases.add(path)
+        self._snapshot = {}
+        # new files that the previous session didn't get to report are reported by the next rescan
+        for path, quiet in pending:
+            self._undelivered[path] = quiet
         # init complete
         self.attached = True
-        return True
 
+    @_exclusive
+    def hibernate(self):
+        """Puts an inactive purrer to sleep: saves the watcher snapshot, and releases log entries and watchers
+        (and the watcher backend), keeping only the lock on the purrlog. wake() loads everything back in,
+        using the manifest and the watcher snapshot, which is quick."""
+        if not self.attached:
+            return
+        dprint(1, "hibernating purrer for", self.logdir)
+        self._writeSnapshot()
+        self._closeBackend()
+        self._resetTables()
+        self.hibernating = True
+
+    @_locked
+    def wake(self):
+        """Wakes up a hibernating purrer."""
+        if not self.hibernating:
+            return
+        dprint(1, "waking up purrer for", self.logdir)
+        self.hibernating = False
+        self._load()
+
+    @_locked
+    def requeueDataProducts(self, dps):
+        """Puts data products returned by rescan() back on the list of new files, for when they could not be
+        used (e.g. because this purrer was no longer the current one by the time they came in). They are reported
+        again by the next rescan, after waking up if the purrer is hibernating."""
+        pending = [(dp.sourcepath, bool(dp.quiet)) for dp in dps]
+        if self.attached:
+            for path, quiet in pending:
+                self._undelivered[path] = quiet and self._undelivered.get(path, True)
+        # a hibernating purrer still holds the lock on the purrlog, so its snapshot can be updated
+        elif self.hibernating:
+            snapshot_time, watchers, pending0 = self._readSnapshot()
+            self._writeSnapshot(watchers, sorted(set(map(tuple, pending0)).union(pending)))
+        else:
+            dprint(1, "purrer for", self.logdir, "is detached, dropping", len(pending), "new data products")
+
+    def memoryReport(self):
+        """Returns dict describing what this purrer is holding in memory: numbers of entries (and of entries
+        that have been fully loaded), data products, watchers, and approximate size of watcher objects in bytes."""
+        with self._lock:
+            loaded = [entry for entry in self.entries if entry.isLoaded()]
+            watchers = list(self.watchers.values()) + list(self.temp_watchers.values())
+            return dict(hibernating=self.hibernating, entries=len(self.entries), loaded_entries=len(loaded),
+                        dps=sum([len(entry.dps) for entry in loaded]),
+                        watchers=len(self.watchers), temp_watchers=len(self.temp_watchers),
+                        watcher_bytes=sum([sys.getsizeof(watcher) for watcher in watchers]))
+
+    def _loadEntries(self, fnames, manifest, lazy):
+        """Loads the given entry subdirectories of the log. Returns list of LogEntry objects, in the same
+        order as 'fnames'. Entries that fail to load are reported and skipped.
+        If the load-workers setting is >0, entries are loaded concurrently by a pool of that many worker processes
+        (or threads, if load-pool is set to "thread")."""
+        nworkers = min(Config.getint("load-workers", 0), len(fnames))
+        if nworkers > 1:
+            pooltype = Config.get("load-pool", "process")
+            if pooltype == "thread":
+                pool = concurrent.futures.ThreadPoolExecutor(nworkers)
+            else:
+                pool = concurrent.futures.ProcessPoolExecutor(nworkers)
+            dprintf(1, "loading %d entries using %d %s workers\n", len(fnames), nworkers, pooltype)
+            futures = [pool.submit(_load_entry, os.path.join(self.logdir, fname), manifest.get(fname), lazy)
+                       for fname in fnames]
+        else:
+            pool = None
+        entries = []
+        try:
+            for i, fname in enumerate(fnames):
+                pathname = os.path.join(self.logdir, fname)
+                try:
+                    if pool is not None:
+                        entry = futures[i].result()
+                    else:
+                        entry = _load_entry(pathname, manifest.get(fname), lazy)
+                    dprint(2, "loaded log entry", pathname)
+                except:
+                    print(("Error loading entry %s, skipping" % fname))
+                    traceback.print_exc()
+                    continue
+                entries.append(entry)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        return entries
+
+    @_locked
     def setWatchedFilePatterns(self, watch, ignore=[]):
         self._watch = watch
         self._ignore = ignore
-        self._watch_patterns = set()
-        for desc, patts in self._watch:
-            self._watch_patterns.update(patts)
+        self._watch_patterns = PatternSet.fromPatternList(self._watch)
         dprint(1, "watching patterns", self._watch_patterns)
-        self._ignore_patterns = set()
-        for desc, patts in self._ignore:
-            self._ignore_patterns.update(patts)
+        self._ignore_patterns = PatternSet.fromPatternList(self._ignore)
         dprint(1, "ignoring patterns", self._ignore_patterns)
         Config.set("watch-patterns", make_pattern_list(self._watch))
         Config.set("ignore-patterns", make_pattern_list(self._ignore))
 
+    @_locked
     def setWatchingState(self, path, watching, save_config=True):
         dprintf(2, "%s: watching state is %d\n", path, watching)
+        # a directory coming back from UNWATCHED or REMOVED has not been polled in the meantime, so
+        # its watchers need to catch up quietly, or else we'd pounce on everything that changed while it was off
+        if path in self._watching_state and not self._isGroupEnabled(path) and watching > Purr.UNWATCHED:
+            self._resync_dirs.add(path)
         self._watching_state[path] = watching
         path = Kittens.utils.collapseuser(path)
         if watching == Purr.REMOVED:
@@ -523,6 +1153,7 @@ class Purrer(QObject):
     def watchedDirectories(self):
         return [(dd, state) for dd, state in list(self._watching_state.items()) if state != Purr.REMOVED]
 
+    @_locked
     def addWatchedDirectory(self, dirname, watching=Purr.WATCHED, save_config=True):
         """Starts watching the specified directories for changes"""
         # see if we're alredy watching this exact set of directories -- do nothing if so
@@ -537,46 +1168,59 @@ class Purrer(QObject):
             if watching is None:
                 watching = Purr.WATCHED
             # make watcher object
-            wdir = Purrer.WatchedDir(dirname, mtime=self.timestamp,
+            wdir = Purrer.WatchedDir(dirname, mtime=self.timestamp, snapshot=self._snapshot.get(dirname),
                                      watch_patterns=self._watch_patterns, ignore_patterns=self._ignore_patterns)
             # fileset=None indicates error reading directory, so ignore it
             if wdir.fileset is None:
                 print(("There was an error reading the directory %s, will stop watching it." % dirname))
                 self.setWatchingState(dirname, Purr.REMOVED, save_config=True)
                 return
-            self.watchers[dirname] = wdir
+            self._addWatcher(dirname, wdir)
             self.watched_dirs.append(dirname)
             dprintf(2, "watching directory %s, mtime %s, %d files\n",
                     dirname, time.strftime("%x %X", time.localtime(wdir.mtime)), len(wdir.fileset))
             # find files in this directory matching the watch_patterns, and watch them for changes
-            watchset = set()
-            for patt in self._watch_patterns:
-                watchset.update(fnmatch.filter(wdir.fileset, patt))
-            for fname in watchset:
-                quiet = matches_patterns(fname, self._quiet_patterns)
-                fullname = Purr.canonizePath(os.path.join(dirname, fname))
+            for fname in self._watch_patterns.filter(wdir.fileset):
+                quiet = self._quiet_patterns.match(fname)
+                fullname = wdir.entryPath(fname)
                 if fullname not in self.watchers:
-                    wfile = Purrer.WatchedFile(fullname, quiet=quiet, mtime=self.timestamp)
-                    self.watchers[fullname] = wfile
+                    mtime = self._snapshot.get(fullname, {}).get('mtime') or self.timestamp
+                    wfile = Purrer.WatchedFile(fullname, quiet=quiet, mtime=mtime)
+                    self._applyIgnoreTimestamp(fullname, wfile)
+                    self._addWatcher(fullname, wfile)
                     dprintf(3, "watching file %s, timestamp %s, quiet %d\n",
                             fullname, time.strftime("%x %X", time.localtime(wfile.mtime)), quiet)
-            # find subdirectories  matching the subdir_patterns, and watch them for changes
-            for fname in wdir.fileset:
-                fullname = Purr.canonizePath(os.path.join(dirname, fname))
-                if os.path.isdir(fullname):
-                    for desc, dir_patts, canary_patts in self._subdir_patterns:
-                        if matches_patterns(fname, dir_patts):
-                            quiet = matches_patterns(fname, self._quiet_patterns)
-                            wdir = Purrer.WatchedSubdir(fullname, canary_patterns=canary_patts, quiet=quiet,
-                                                        mtime=self.timestamp)
-                            self.watchers[fullname] = wdir
-                            dprintf(3, "watching subdirectory %s/{%s}, timestamp %s, quiet %d\n",
-                                    fullname, ",".join(canary_patts),
-                                    time.strftime("%x %X", time.localtime(wdir.mtime)), quiet)
-                            break
+            # find subdirectories  matching the subdir_patterns, and watch them for changes.
+            # wdir.subdirs comes from the directory scan, so no further stat() calls are needed here.
+            for fname in wdir.subdirs:
+                for desc, dir_patts, canary_patts in self._subdir_patterns:
+                    if dir_patts.match(fname):
+                        fullname = wdir.entryPath(fname)
+                        quiet = self._quiet_patterns.match(fname)
+                        wsubdir = Purrer.WatchedSubdir(fullname, canary_patterns=canary_patts, quiet=quiet,
+                                                       mtime=self.timestamp, snapshot=self._snapshot.get(fullname))
+                        self._applyIgnoreTimestamp(fullname, wsubdir)
+                        self._addWatcher(fullname, wsubdir)
+                        dprintf(3, "watching subdirectory %s/{%s}, timestamp %s, quiet %d\n",
+                                fullname, ",".join(canary_patts),
+                                time.strftime("%x %X", time.localtime(wsubdir.mtime)), quiet)
+                        break
         # set state and save config
         self.setWatchingState(dirname, watching, save_config=save_config)
 
+    def _applyIgnoreTimestamp(self, path, watcher):
+        """If 'path' is in the ignorelist, makes sure the watcher's mtime is no older than the timestamp
+        of the file when it was last ignored. This ensures that we don't pounce on ignored files after restarting purr."""
+        if self.ignorelist is None:
+            return
+        try:
+            ignored = self.ignorelist.lookup(path)
+        except:
+            _printexc("Error reading ignorelist")
+            return
+        if ignored:
+            watcher.mtime = max(watcher.mtime, ignored[0])
+
     def setLogTitle(self, title, save=True):
         self.logtitle = title
         if save:
@@ -590,7 +1234,7 @@ class Purrer(QObject):
         self._initIndexDir()
         # discard temporary watchers -- these are only used to keep track of
         # deleted files
-        self.temp_watchers = {}
+        self._clearTempWatchers()
         # ignored entries are only there to carry info on ignored data products
         # All we do is save them, and update DP policies based on them
         if entry.ignore:
@@ -614,6 +1258,8 @@ class Purrer(QObject):
             # and our log may need to be regenerated
             if save:
                 self.save()
+        if self.journal is not None:
+            self.journal.append("entry", pathname=entry.pathname, ignore=bool(entry.ignore))
         self.updatePoliciesFromEntry(entry, new=True)
 
     def getLogEntries(self):
@@ -671,25 +1317,32 @@ class Purrer(QObject):
         if save:
             self.save()
 
+    @_locked
     def updatePoliciesFromEntry(self, entry, new=True):
-        # populate default policies and renames based on entry list
-        for dp in entry.dps:
+        # populate default policies and renames based on entry list. This uses dataProductInfo(), so that
+        # lazily loaded entries don't need to be fully loaded.
+        for dp in entry.dataProductInfo():
             # add default policy
             basename = os.path.basename(dp.sourcepath)
             self._default_dp_props[basename] = dp.policy, dp.filename, dp.comment
             dprintf(4, "file %s: default policy is %s\n", basename, dp.policy)
             # make new watchers for non-ignored files
             if dp.ignored:
-                # if ignorelistfile is not set, then we're being called from within
-                # _attach(), when older log entries are being loaded. No need to write the file then.
-                if new and self.ignorelistfile and os.path.exists(dp.sourcepath):
+                # if we're not attached yet, then we're being called from within
+                # _attach(), when older log entries are being loaded. No need to record anything then.
+                if new and self.attached and self.ignorelist is not None and os.path.exists(dp.sourcepath):
                     try:
-                        open(self.ignorelistfile, 'a').write(
-                            "%d %s %s\n" % (os.path.getmtime(dp.sourcepath), dp.policy, dp.sourcepath))
+                        self.ignorelist.add(dp.sourcepath, os.path.getmtime(dp.sourcepath), dp.policy)
                     except:
-                        print(("Error writing %s" % self.ignorelistfile))
+                        print(("Error writing %s" % self.ignorelist.filename))
                         traceback.print_exc()
+                if new and self.attached and self.journal is not None:
+                    self.journal.append("policy", path=dp.sourcepath, policy=dp.policy)
             else:
+                if dp.hash:
+                    self._archived_hashes[dp.sourcepath] = dp.hash
+                else:
+                    self._archived_hashes.pop(dp.sourcepath, None)
                 watcher = self.watchers.get(dp.sourcepath, None)
                 # if watcher already exists, update timestamp
                 if watcher:
@@ -700,7 +1353,7 @@ class Purrer(QObject):
                 # else create new watcher
                 else:
                     wfile = Purrer.WatchedFile(dp.sourcepath, quiet=dp.quiet, mtime=dp.timestamp, survive_deletion=True)
-                    self.watchers[dp.sourcepath] = wfile
+                    self._addWatcher(dp.sourcepath, wfile)
                     dprintf(4, "watching file %s, timestamp %s\n",
                             dp.sourcepath, time.strftime("%x %X", time.localtime(dp.timestamp)))
 
@@ -732,65 +1385,421 @@ class Purrer(QObject):
         Purr.RenderIndex.writeLogIndex(self.logdir, self.logtitle, self.timestamp, self.entries, refresh=refresh)
         Purr.progressMessage("Wrote %s" % self.logdir)
 
+    def _readSnapshot(self):
+        """Reads the watcher snapshot file, returns (timestamp, watchers, pending) tuple, where watchers is a dict of
+        path: state, and pending is a list of (path, quiet) pairs for new files that were not reported yet.
+        Returns (0, {}, []) if the snapshot is missing or unusable."""
+        if not os.path.exists(self.snapshotfile):
+            return 0, {}, []
+        try:
+            with gzip.open(self.snapshotfile, 'rt') as fobj:
+                snapshot = json.load(fobj)
+            if snapshot.get('logdir') != self.logdir:
+                dprint(1, "watcher snapshot", self.snapshotfile, "belongs to a different log, ignoring")
+                return 0, {}, []
+            dprintf(1, "loaded watcher snapshot with %d entries\n", len(snapshot['watchers']))
+            return snapshot.get('timestamp', 0), snapshot['watchers'], snapshot.get('pending', [])
+        except:
+            _printexc("Error reading %s, ignoring", self.snapshotfile)
+            return 0, {}, []
+
+    def _replayJournal(self, snapshot_time):
+        """Replays the event journal on top of the watcher snapshot (self._snapshot). Records older than
+        the snapshot are already covered by it, and are skipped (they can only be there if we crashed in
+        between writing the snapshot and truncating the journal)."""
+        if self.journal is None:
+            return
+        counts = {}
+        for record in self.journal.replay():
+            if record['t'] < snapshot_time:
+                continue
+            ev = record['ev']
+            counts[ev] = counts.get(ev, 0) + 1
+            if ev == "watch":
+                if 'delta' in record:
+                    self._applySnapshotDelta(record['path'], record['delta'])
+                else:
+                    self._snapshot[record['path']] = record['state']
+            # files that were pounced on get watchers of their own on attach, these need to start from
+            # the timestamps at pounce time. (Directories are covered by the "watch" records of their parents.)
+            elif ev == "pounce":
+                for path, mtime in record['files']:
+                    if not os.path.isdir(path):
+                        state = self._snapshot.setdefault(path, {})
+                        state['mtime'] = max(state.get('mtime') or 0, mtime)
+            # the other events (policies, entries) are already reflected in the log itself
+        if counts:
+            dprint(1, "replayed journal events:", counts)
+
+    def _applySnapshotDelta(self, path, delta):
+        """Applies a watcher state delta from the journal (see WatchedDir.snapshotDelta()) to the watcher's
+        state in self._snapshot."""
+        state = self._snapshot.get(path)
+        # the journal always has a full state ahead of the deltas, so this shouldn't happen
+        if state is None or 'fileset' not in state:
+            dprint(1, "journal has changes for", path, "but no earlier state, ignoring")
+            return
+        fileset = state['fileset']
+        if not isinstance(fileset, set):
+            fileset = state['fileset'] = set(fileset)
+        fileset.difference_update(delta.pop('removed', []))
+        fileset.update(delta.pop('added', []))
+        state.update(delta)
+
+    def watcherSnapshot(self):
+        """Returns a snapshot of the current state of all watchers, as a dict of path: state."""
+        with self._lock:
+            return dict([(path, watcher.snapshot()) for path, watcher in self.watchers.items()])
+
+    def _pendingSnapshot(self):
+        """Returns list of (path, quiet) pairs for new files that have been found but not yet reported, including
+        those held back by content hash checks. Call with the lock held."""
+        pending = dict(self._undelivered)
+        for path, (future, quiet) in self._hash_checks.items():
+            pending.setdefault(path, quiet)
+        return sorted([(path, bool(quiet)) for path, quiet in pending.items()])
+
+    def _writeSnapshot(self, watchers=None, pending=None):
+        """Writes snapshot of watcher state to the purrlog. The file is written under a temporary name first,
+        then renamed, so a crash never leaves a truncated snapshot behind. If 'watchers' and 'pending' are given,
+        they are written instead of the current state (see requeueDataProducts())."""
+        current = watchers is None
+        if current:
+            watchers = self.watcherSnapshot()
+            pending = self._pendingSnapshot()
+        snapshot = dict(logdir=self.logdir, timestamp=time.time(), watchers=watchers, pending=pending)
+        tmpfile = self.snapshotfile + ".tmp"
+        try:
+            with gzip.open(tmpfile, 'wt') as fobj:
+                json.dump(snapshot, fobj, separators=(',', ':'))
+            os.rename(tmpfile, self.snapshotfile)
+            dprintf(1, "wrote watcher snapshot with %d entries, %d pending files\n", len(watchers), len(pending))
+        except:
+            _printexc("Error writing %s", self.snapshotfile)
+            return
+        if current:
+            # the journal can now record changes against the snapshot
+            self._journal_bases = set(watchers)
+            # the snapshot is a checkpoint, so the journal can start afresh
+            if self.journal is not None:
+                self.journal.checkpoint()
+
+    @staticmethod
+    def _groupKey(watcher):
+        """Returns the key under which a watcher is kept in the directory index."""
+        if watcher.survive_deletion:
+            return None
+        return watcher.ownerDir()
+
+    def _isGroupEnabled(self, key):
+        """Returns True if the watchers indexed under the given key are to be polled. Only directories
+        explicitly set to UNWATCHED (or REMOVED) are disabled."""
+        return key is None or self._watching_state.get(key, Purr.WATCHED) > Purr.UNWATCHED
+
+    @_locked
+    def _addWatcher(self, path, watcher, watchers=None):
+        """Adds watcher to the given dict of watchers (self.watchers by default), replacing any previous
+        watcher of the same path, and registers it with the watcher backend."""
+        if watchers is None:
+            watchers = self.watchers
+        self._removeWatcher(path, watchers)
+        watcher.event_driven = self._backend.watch(watcher.watchDir())
+        # the backend only reports changes from now on, so make sure a new watcher is polled at least once,
+        # to catch up with anything that happened before the watch was placed
+        if watcher.event_driven:
+            self._backend.markChanged(path)
+        watchers[path] = watcher
+        if watchers is self.watchers:
+            self._dir_index.setdefault(self._groupKey(watcher), {})[path] = watcher
+
+    @_locked
+    def _removeWatcher(self, path, watchers=None):
+        """Removes watcher from the given dict of watchers (self.watchers by default), and releases its backend watch."""
+        if watchers is None:
+            watchers = self.watchers
+        watcher = watchers.pop(path, None)
+        if watcher is None:
+            return
+        if watchers is self.watchers:
+            key = self._groupKey(watcher)
+            group = self._dir_index.get(key)
+            if group is not None:
+                group.pop(path, None)
+                if not group:
+                    del self._dir_index[key]
+        if watcher.event_driven:
+            self._backend.unwatch(watcher.watchDir())
+            watcher.event_driven = False
+
+    @_locked
+    def _clearTempWatchers(self):
+        for path in list(self.temp_watchers.keys()):
+            self._removeWatcher(path, self.temp_watchers)
+
+    def _needsPoll(self, watcher, changed, now):
+        """Returns True if watcher needs to be polled during this rescan. 'changed' is the set of paths
+        reported as changed by the watcher backend, or None if the backend can't tell."""
+        if watcher.hasPending():
+            return True
+        if watcher.event_driven:
+            # None means the backend has lost track of events, so poll everything
+            if changed is None:
+                return True
+            if self._backend.isWatching(watcher.watchDir()):
+                return watcher.path in changed or self._event_scheduler.isDue(watcher, now)
+            # else backend has lost the watch (e.g. directory was deleted), so go back to polling
+        return self._scheduler.isDue(watcher, now)
+
+    def _reschedule(self, watcher, active, now):
+        """Reschedules watcher after it has been polled, with the fallback interval if it is event-driven."""
+        scheduler = self._event_scheduler if watcher.event_driven else self._scheduler
+        scheduler.update(watcher, active, now)
+
+    def _prefetchStats(self, watchers):
+        """Stats all files that the given watchers are about to look at, using the thread pool, and stores
+        the results in the current thread's stat cache. The watchers themselves are then checked sequentially
+        (in the same order as without the pool), so the outcome of a rescan does not depend on the pool."""
+        pool = self._stat_pool
+        if pool is None:
+            return
+        paths = []
+        for watcher in watchers:
+            paths += watcher.statPaths()
+        if len(paths) < 2:
+            return
+        stats = getattr(_stat_cache, 'stats', None) or {}
+        try:
+            stats.update(zip(paths, pool.map(_try_stat, paths)))
+        except RuntimeError:
+            # pool has been shut down by detach()
+            return
+        _stat_cache.stats = stats
+        dprintf(5, "prefetched %d stats\n", len(paths))
+
+    @_locked
+    def wakeWatchers(self, path):
+        """Makes sure the watchers of 'path', and of the directory containing it, are polled on the next rescan.
+        This is called when we receive outside hints of activity, e.g. a pounce command from a Purr pipe."""
+        path = Purr.canonizePath(path)
+        for wpath in path, os.path.dirname(path):
+            for watchers in self.watchers, self.temp_watchers:
+                watcher = watchers.get(wpath)
+                if watcher is not None:
+                    self._scheduler.wake(watcher)
+
+    @_locked
+    def _processBackendEvents(self, fd=None):
+        """Called when the watcher backend has events pending. Reads them in, and lets the world know
+        that a rescan is worth doing."""
+        self._backend.readEvents()
+        self.emit(SIGNAL("watchedPathsChanged"))
+
+    def _processSharedEvents(self):
+        """Called when the shared watch service has read in events. Only the purrers that have been
+        handed some of them need a rescan."""
+        if self._backend.hasChanges():
+            self.emit(SIGNAL("watchedPathsChanged"))
+
+    def _checkArchivedHashes(self, newstuff, generation):
+        """Weeds out files from the newstuff dict (as built up by rescan()) whose content is the same as that of
+        their last archived version in the object store. A file that has a different size has changed for sure.
+        Else its content needs to be hashed, which takes a while for a big file, so this is done in a worker
+        thread, and the file is held back in the meantime. Files found to have changed by earlier checks are added
+        to newstuff."""
+        store = self.store
+        for path, quiet in list(newstuff.items()):
+            digest = self._archived_hashes.get(Purr.canonizePath(path))
+            if not digest or not os.path.isfile(path):
+                continue
+            try:
+                if os.path.getsize(path) != store.objectSize(digest):
+                    continue
+            except OSError:
+                continue
+            dprintf(3, "%s has the same size as its archived version, checking its hash\n", path)
+            with self._lock:
+                if self._isStale(generation):
+                    return
+                # newstuff is part of the snapshot (see rescan()), so the file is moved over to the hash checks
+                # with the lock held
+                del newstuff[path]
+                if self._hash_pool is None:
+                    self._hash_pool = concurrent.futures.ThreadPoolExecutor(1)
+                future = self._hash_pool.submit(store.isUnchanged, path, digest)
+                # a later check replaces an earlier one, since the file may have changed again
+                self._hash_checks[path] = future, quiet
+            # get a rescan going once the result is in
+            future.add_done_callback(lambda future: self.emit(SIGNAL("watchedPathsChanged")))
+        with self._lock:
+            if self._isStale(generation):
+                return
+            for path, (future, quiet) in list(self._hash_checks.items()):
+                if not future.done():
+                    continue
+                del self._hash_checks[path]
+                # a failed check counts as a change
+                if future.exception() is None and future.result():
+                    dprintf(2, "%s is unchanged since it was last archived, ignoring\n", path)
+                elif path not in newstuff:
+                    newstuff[path] = quiet
+
+    def _isStale(self, generation):
+        """Returns True if the watcher tables have been torn down since 'generation' was taken. Call with the lock held."""
+        return generation != self._generation or not self.attached
+
     def rescan(self):
         """Checks files and directories on watchlist for updates, rescans them for new data products.
-        If any are found, returns them. Skips those in directories whose watchingState is set to Purr.UNWATCHED.
+        If any are found, returns them. Skips those in directories whose watchingState is set to Purr.UNWATCHED:
+        their watchers are not polled at all, and catch up quietly once the directory is re-enabled.
+        This may be called from a worker thread: the purrer's lock is only held while the watcher tables
+        are being read or modified, not while the watchers are doing their (possibly slow) filesystem checks.
         """
         if not self.attached:
             return
         dprint(5, "starting rescan")
-        newstuff = {};  # this accumulates names of new or changed files. Keys are paths, values are 'quiet' flag.
-        # store timestamp of scan
-        self.last_scan_timestamp = time.time()
-        # go through watched files/directories, check for mtime changes
-        for path, watcher in list(self.watchers.items()):
-            # get list of new files from watcher
-            newfiles = watcher.newFiles()
-            # None indicates access error, so drop it from watcher set
-            if newfiles is None:
-                if watcher.survive_deletion:
-                    dprintf(5, "access error on %s, but will still be watched\n", watcher.path)
-                else:
-                    dprintf(2, "access error on %s, will no longer be watched\n", watcher.path)
-                    del self.watchers[path]
-                if not watcher.disappeared:
-                    self.emit(SIGNAL("disappearedFile"), path)
-                    watcher.disappeared = True
-                continue
-            dprintf(5, "%s: %d new file(s)\n", watcher.path, len(newfiles))
-            # if a file has its own watcher, and is independently reported by a directory watcher, skip the directory's
-            # version and let the file's watcher report it. Reason for this is that the file watcher may have a more
-            # up-to-date timestamp, so we trust it over the dir watcher.
-            newfiles = [p for p in newfiles if p is path or p not in self.watchers]
-            # skip files in self._unwatched_paths
-            newfiles = [filename for filename in newfiles if
-                        self._watching_state.get(os.path.dirname(filename)) > Purr.UNWATCHED]
-            # Now go through files and add them to the newstuff dict
-            for newfile in newfiles:
-                # if quiet flag is explicitly set on watcher, enforce it
-                # if not pouncing on directory, also add quietly
-                if watcher.quiet or self._watching_state.get(os.path.dirname(newfile)) < Purr.POUNCE:
-                    quiet = True
-                # else add quietly if file is not in the quiet patterns
+        _stat_cache.stats = None
+        with self._lock:
+            # if the purrer is hibernated or detached while we're polling, the rest of the rescan is dropped
+            generation = self._generation
+            if not self.attached:
+                return
+            # this accumulates names of new or changed files. Keys are paths, values are 'quiet' flag. Until they
+            # are handed out at the end, they are part of the snapshot, so hibernation or detaching loses nothing.
+            newstuff = self._undelivered
+            # store timestamp of scan
+            self.last_scan_timestamp = now = time.time()
+            # get set of changed paths from the backend (None if everything needs to be polled)
+            changed = self._backend.changedPaths()
+            # make list of watchers that are due to be polled, skipping disabled directories entirely.
+            # Watchers of re-enabled directories are all polled, but what they find is not reported.
+            resync_dirs, self._resync_dirs = self._resync_dirs, set()
+            polled = []
+            for key, group in self._dir_index.items():
+                if not self._isGroupEnabled(key):
+                    continue
+                if key in resync_dirs:
+                    dprintf(2, "%s has been re-enabled, resyncing %d watchers\n", key, len(group))
+                    polled += [(path, watcher, True) for path, watcher in group.items()]
                 else:
-                    quiet = matches_patterns(os.path.basename(newfile), self._quiet_patterns)
-                # add file to list of new products. Since a file may be reported by multiple
-                # watchers, make the quiet flag a logical AND of all the quiet flags (i.e. DP will be
-                # marked as quiet only if all watchers report it as quiet).
-                newstuff[newfile] = quiet and newstuff.get(newfile, True)
-                dprintf(4, "%s: new data product, quiet=%d (watcher quiet: %s)\n", newfile, quiet, watcher.quiet)
-                # add a watcher for this file to the temp_watchers list. this is used below
-                # to detect renamed and deleted files
-                self.temp_watchers[newfile] = Purrer.WatchedFile(newfile)
+                    polled += [(path, watcher, False) for path, watcher in group.items()
+                               if self._needsPoll(watcher, changed, now)]
+        self._prefetchStats([watcher for path, watcher, resync in polled])
+        # watchers that have found something, or whose directory listing has changed, and whose new state
+        # therefore goes into the journal: list of (path, watcher, previous listing)
+        journaled = []
+        # go through watched files/directories, check for mtime changes
+        for path, watcher, resync in polled:
+            # hibernate() and detach() wait while a watcher is being polled, so what it finds is either recorded
+            # in newstuff or still there to be found, whenever they write the snapshot
+            with self._poll_lock:
+                with self._lock:
+                    if self._isStale(generation):
+                        dprint(2, "purrer was hibernated or detached during rescan, dropping results")
+                        return
+                # get list of new files from watcher, and reschedule it based on whether anything was found
+                mtime0 = watcher.mtime
+                fileset0 = getattr(watcher, 'fileset', None)
+                newfiles = watcher.newFiles(self._settle)
+                self._reschedule(watcher, bool(newfiles) or watcher.mtime != mtime0, now)
+                # None indicates access error, so drop it from watcher set
+                if newfiles is None:
+                    if watcher.survive_deletion:
+                        dprintf(5, "access error on %s, but will still be watched\n", watcher.path)
+                    else:
+                        dprintf(2, "access error on %s, will no longer be watched\n", watcher.path)
+                        with self._lock:
+                            if self.watchers.get(path) is watcher:
+                                self._removeWatcher(path)
+                    if not watcher.disappeared:
+                        self.emit(SIGNAL("disappearedFile"), path)
+                        watcher.disappeared = True
+                    continue
+                if newfiles or fileset0 is not getattr(watcher, 'fileset', None):
+                    journaled.append((path, watcher, fileset0))
+                if not newfiles or resync:
+                    continue
+                dprintf(5, "%s: %d new file(s)\n", watcher.path, len(newfiles))
+                with self._lock:
+                    # if a file has its own watcher, and is independently reported by a directory watcher, skip the directory's
+                    # version and let the file's watcher report it. Reason for this is that the file watcher may have a more
+                    # up-to-date timestamp, so we trust it over the dir watcher.
+                    newfiles = [p for p in newfiles if p == path or p not in self.watchers]
+                    # skip files in self._unwatched_paths
+                    newfiles = [filename for filename in newfiles if
+                                self._watching_state.get(os.path.dirname(filename), Purr.UNWATCHED) > Purr.UNWATCHED]
+                    # Now go through files and add them to the newstuff dict
+                    for newfile in newfiles:
+                        # if quiet flag is explicitly set on watcher, enforce it
+                        # if not pouncing on directory, also add quietly
+                        if watcher.quiet or self._watching_state.get(os.path.dirname(newfile), Purr.UNWATCHED) < Purr.POUNCE:
+                            quiet = True
+                        # else add quietly if file is not in the quiet patterns
+                        else:
+                            quiet = self._quiet_patterns.match(os.path.basename(newfile))
+                        # add file to list of new products. Since a file may be reported by multiple
+                        # watchers, make the quiet flag a logical AND of all the quiet flags (i.e. DP will be
+                        # marked as quiet only if all watchers report it as quiet).
+                        newstuff[newfile] = quiet and newstuff.get(newfile, True)
+                        dprintf(4, "%s: new data product, quiet=%d (watcher quiet: %s)\n", newfile, quiet, watcher.quiet)
+                        # add a watcher for this file to the temp_watchers list. this is used below
+                        # to detect renamed and deleted files
+                        self._addWatcher(newfile, Purrer.WatchedFile(newfile), self.temp_watchers)
         # now, go through temp_watchers to see if any newly pounced-on files have disappeared
-        for path, watcher in list(self.temp_watchers.items()):
+        with self._lock:
+            polled = [(path, watcher) for path, watcher in self.temp_watchers.items()
+                      if self._needsPoll(watcher, changed, now)]
+        self._prefetchStats([watcher for path, watcher in polled])
+        for path, watcher in polled:
             # get list of new files from watcher
-            if watcher.newFiles() is None:
+            mtime0 = watcher.mtime
+            newfiles = watcher.newFiles(self._settle)
+            self._reschedule(watcher, bool(newfiles) or watcher.mtime != mtime0, now)
+            if newfiles is None:
                 dprintf(2, "access error on %s, marking as disappeared", watcher.path)
-                del self.temp_watchers[path]
+                with self._lock:
+                    if self.temp_watchers.get(path) is watcher:
+                        self._removeWatcher(path, self.temp_watchers)
                 self.emit(SIGNAL("disappearedFile"), path)
+        _stat_cache.stats = None
+        # files whose content is the same as when they were last archived have only been touched,
+        # so there's nothing new to pounce on
+        if self.store is not None:
+            self._checkArchivedHashes(newstuff, generation)
         # if we have new data products, send them to the main window
-        return self.makeDataProducts(iter(list(newstuff.items())))
+        with self._lock:
+            if self._isStale(generation):
+                dprint(2, "purrer was hibernated or detached during rescan, dropping results")
+                return
+            # the new files are handed out now, so they're no longer part of the snapshot. If the main window
+            # can't use them after all, it gives them back through requeueDataProducts()
+            self._undelivered = {}
+            dps = self.makeDataProducts(iter(list(newstuff.items())))
+            if self.journal is not None and self.attached:
+                # a directory listing can be huge, so it is only recorded in full the first time around,
+                # and after that only the changes to it are
+                for path, watcher, fileset0 in journaled:
+                    if path in self._journal_bases and fileset0 is not None:
+                        self.journal.append("watch", path=path, delta=watcher.snapshotDelta(fileset0))
+                    else:
+                        self.journal.append("watch", path=path, state=watcher.snapshot())
+                        self._journal_bases.add(path)
+                # record the timestamps of pounced-on files, so that we don't pounce on them again after a crash
+                pounced = [(path, watcher.mtime) for path, watcher in self.temp_watchers.items()
+                           if path in newstuff]
+                if pounced:
+                    self.journal.append("pounce", files=pounced)
+                # checkpoint once the journal gets long, to keep restarts quick
+                if len(self.journal) >= Config.getint("journal-checkpoint", 1000):
+                    self._writeSnapshot()
+            return dps
+
+    def archiveMode(self, path):
+        """Returns the archive mode for a file, as given by the archive-modes configuration."""
+        basename = os.path.basename(path)
+        for mode, patterns in self._archive_modes:
+            if patterns.match(basename):
+                return mode
+        return "copy"
 
     def makeDataProducts(self, files, unbanish=False, unignore=False):
         """makes a list of DPs from a list of (filename,quiet) pairs.
@@ -815,7 +1824,8 @@ class Purrer(QObject):
                 if unignore and policy == "ignore":
                     policy = "copy"
                 dps.append(Purr.DataProduct(filename=filename, sourcepath=sourcepath,
-                                            policy=policy, comment=comment, quiet=quiet))
+                                            policy=policy, comment=comment, quiet=quiet,
+                                            archive_mode=self.archiveMode(sourcepath)))
         import six
         from past.builtins import cmp
         from functools import cmp_to_key
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""Purr.RescanWorker runs Purrer rescans in a background thread, so that slow filesystems never block the GUI."""
+
+import threading
+import time
+import traceback
+
+from PyQt4.Qt import QThread, SIGNAL
+
+from Purr import dprintf
+
+
+class RescanStats(object):
+    """Keeps track of how long rescans take."""
+
+    def __init__(self):
+        self.count = 0
+        self.last = self.total = self.max = 0.
+        # number of rescan requests that were merged into an already pending one
+        self.coalesced = 0
+
+    def add(self, duration):
+        self.count += 1
+        self.last = duration
+        self.total += duration
+        self.max = max(self.max, duration)
+
+    def mean(self):
+        return self.total / (self.count or 1)
+
+    def __str__(self):
+        return "%d rescans, last %.3fs, mean %.3fs, max %.3fs, %d requests coalesced" % (
+            self.count, self.last, self.mean(), self.max, self.coalesced)
+
+
+class RescanWorker(QThread):
+    """A RescanWorker is a thread that calls Purrer.rescan() on request.
+    There is at most one rescan in flight at any time: requests that arrive while a rescan is running or
+    pending are coalesced into a single "rescan requested" flag. When a rescan is done, the worker emits
+    SIGNAL("rescanFinished") with the Purrer object and the list of new data products as arguments.
+    Since the signal is emitted from the worker thread, it is delivered to GUI objects via a queued
+    connection. Likewise, the Purrer's own "disappearedFile" signals are queued up.
+    """
+
+    def __init__(self, parent=None):
+        QThread.__init__(self, parent)
+        self._cond = threading.Condition()
+        self._purrer = None
+        self._requested = False
+        self._stopping = False
+        self.stats = RescanStats()
+
+    def requestRescan(self, purrer):
+        """Requests a rescan of the given Purrer. If a rescan request is already pending, it is retargeted
+        to this Purrer."""
+        with self._cond:
+            if self._requested:
+                self.stats.coalesced += 1
+            self._purrer = purrer
+            self._requested = True
+            self._cond.notify()
+
+    def isBusy(self):
+        """Returns True if a rescan is running or pending."""
+        with self._cond:
+            return self._requested or self._purrer is not None
+
+    def stop(self):
+        """Stops the worker thread, waiting for any rescan in progress to complete."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self.wait()
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._requested and not self._stopping:
+                    self._purrer = None
+                    self._cond.wait()
+                if self._stopping:
+                    return
+                self._requested = False
+                purrer = self._purrer
+            t0 = time.time()
+            try:
+                dps = purrer.rescan() or []
+            except:
+                print("Error during rescan:")
+                traceback.print_exc()
+                dps = []
+            self.stats.add(time.time() - t0)
+            dprintf(3, "rescan done: %s\n", self.stats)
+            self.emit(SIGNAL("rescanFinished"), purrer, dps)
@@ -1,5 +1,4 @@
 # -*- coding: utf-8 -*-
-import glob
 import os
 import os.path
 
@@ -65,7 +64,7 @@ def startWizard(args, mainwin, modal=True):
         parent = os.path.dirname(os.path.normpath(create)) or os.getcwd()
         # if parent is valid dir, find purrlogs in parent (to offer as an option)
         if os.path.isdir(parent):
-            purrlogs = list(filter(Purr.Purrer.is_purrlog, glob.glob(os.path.join(parent, "*"))))
+            purrlogs = Purr.Purrer.find_purrlogs(parent)
         # else use "." as dirname, and do not offer any purrlogs
         else:
             purrlogs = []
@@ -78,7 +77,7 @@ def startWizard(args, mainwin, modal=True):
             mainwin.show()
             return True
         # case 2c-2e. Look for purrlogs in dirname
-        purrlogs = list(filter(Purr.Purrer.is_purrlog, glob.glob(os.path.join(dirname, "*"))))
+        purrlogs = Purr.Purrer.find_purrlogs(dirname)
         # case 2c: exactly one purrlog. Attach without asking.
         if len(purrlogs) == 1:
             mainwin.show()
@@ -131,7 +130,7 @@ class PurrStartupWizard(QWizard):
                 self.rbs_log = []
             else:
                 # add options for existing purrlogs
-                self.rbs_log = [QRadioButton("Load %s" % Kittens.utils.collapseuser(log)) for log in purrlogs]
+                self.rbs_log = [QRadioButton(self._logLabel(log)) for log in purrlogs]
                 for rb in self.rbs_log:
                     lo.addWidget(rb)
                     bg.addButton(rb)
@@ -197,6 +196,17 @@ class PurrStartupWizard(QWizard):
             if not purrlogs:
                 self.rb_create.setChecked(True)
 
+        @staticmethod
+        def _logLabel(log):
+            """Returns label for the "load purrlog" option: its path, plus the log title, if one can be read."""
+            label = "Load %s" % Kittens.utils.collapseuser(log)
+            indexfile = os.path.join(log, "index.html")
+            if os.path.exists(indexfile):
+                title, timestamp = Purr.Parsers.parseLogHeader(indexfile)
+                if title:
+                    label += " (%s)" % title
+            return label
+
         def _select_other_dialog(self):
             path = str(QFileDialog.getExistingDirectory(self, "Select purrlog", self.dirname))
             if not path:
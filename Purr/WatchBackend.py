@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""Purr.WatchBackend provides change-notification backends for the Purrer's file and directory watchers.
+
+A backend is told which directories the watchers live in. On every rescan, the Purrer asks the backend
+for the set of paths that have changed since the last call, and only polls (i.e. stats) the watchers
+whose paths appear in that set. Watchers that the backend could not register are polled every time, as
+are all watchers if the backend cannot tell what has changed.
+
+Two backends are provided: PollingBackend (which reports nothing, so everything is always polled), and
+InotifyBackend, which uses the Linux inotify interface via ctypes.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import os.path
+import struct
+import sys
+
+from Purr import dprint, dprintf
+
+# inotify event masks, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+# this is the set of events we ask for on every watched directory
+_WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+               IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+# struct inotify_event header: int wd; uint32_t mask, cookie, len; followed by len bytes of name
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+class PollingBackend(object):
+    """The default backend. It never registers any watches, so every watcher is polled on every rescan."""
+
+    def watch(self, dirname):
+        """Starts watching a directory. Returns True if changes to the directory and its immediate
+        contents will be reported by changedPaths(), False if the caller has to poll it."""
+        return False
+
+    def unwatch(self, dirname):
+        """Releases a watch obtained by watch()."""
+        pass
+
+    def isWatching(self, dirname):
+        """Returns True if the directory is still being watched by the backend."""
+        return False
+
+    def fileno(self):
+        """Returns a file descriptor that becomes readable when events are pending, or None."""
+        return None
+
+    def readEvents(self):
+        """Reads pending events into the backend's internal change set."""
+        pass
+
+    def markChanged(self, path):
+        """Adds a path to the change set, so that it is returned by the next changedPaths()."""
+        pass
+
+    def changedPaths(self):
+        """Returns set of paths changed since the last call, or None if everything needs to be polled."""
+        return None
+
+    def close(self):
+        pass
+
+
+class InotifyBackend(PollingBackend):
+    """Backend based on Linux inotify. One inotify watch is placed per directory (watches are reference-counted,
+    since many file watchers share a directory). Events on a directory entry mark both the entry and
+    the directory itself as changed."""
+
+    class Unavailable(RuntimeError):
+        pass
+
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise InotifyBackend.Unavailable("inotify is only available on Linux")
+        libname = ctypes.util.find_library("c") or "libc.so.6"
+        try:
+            libc = ctypes.CDLL(libname, use_errno=True)
+            self._init1 = libc.inotify_init1
+            self._add_watch = libc.inotify_add_watch
+            self._rm_watch = libc.inotify_rm_watch
+        except (OSError, AttributeError) as exc:
+            raise InotifyBackend.Unavailable("can't load inotify functions from %s: %s" % (libname, exc))
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self._fd = self._init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise InotifyBackend.Unavailable("inotify_init1() failed: %s" % os.strerror(ctypes.get_errno()))
+        # watch descriptor -> dirname, and reverse mapping
+        self._wd_path = {}
+        self._path_wd = {}
+        # dirname -> reference count
+        self._refcount = {}
+        # accumulated set of changed paths, or None after a queue overflow
+        self._changed = set()
+        # set to True once we hit the watch limit, so that we don't keep trying
+        self._exhausted = False
+
+    def watch(self, dirname):
+        if self._fd is None:
+            return False
+        if dirname in self._path_wd:
+            self._refcount[dirname] += 1
+            return True
+        if self._exhausted:
+            return False
+        wd = self._add_watch(self._fd, os.fsencode(dirname), _WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                print(("inotify watch limit reached, directories beyond %d will be polled" % len(self._path_wd)))
+                self._exhausted = True
+            else:
+                dprintf(2, "inotify_add_watch(%s) failed: %s\n", dirname, os.strerror(err))
+            return False
+        dprintf(3, "inotify watch %d on %s\n", wd, dirname)
+        # the same directory (under a different name) may already be watched
+        olddir = self._wd_path.get(wd)
+        if olddir is not None and olddir != dirname:
+            self._path_wd.pop(olddir, None)
+            self._refcount.pop(olddir, None)
+        self._wd_path[wd] = dirname
+        self._path_wd[dirname] = wd
+        self._refcount[dirname] = 1
+        return True
+
+    def unwatch(self, dirname):
+        if dirname not in self._refcount:
+            return
+        self._refcount[dirname] -= 1
+        if self._refcount[dirname] > 0:
+            return
+        del self._refcount[dirname]
+        wd = self._path_wd.pop(dirname)
+        self._wd_path.pop(wd, None)
+        if self._fd is not None:
+            self._rm_watch(self._fd, wd)
+
+    def isWatching(self, dirname):
+        return dirname in self._path_wd
+
+    def fileno(self):
+        return self._fd
+
+    def readEvents(self):
+        if self._fd is None:
+            return
+        while True:
+            try:
+                buf = os.read(self._fd, 65536)
+            except BlockingIOError:
+                return
+            except OSError:
+                dprint(1, "error reading inotify events, falling back to polling")
+                self._changed = None
+                return
+            if not buf:
+                return
+            self._parseEvents(buf)
+
+    def _parseEvents(self, buf):
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(buf):
+            wd, mask, cookie, namelen = _EVENT_HEADER.unpack_from(buf, offset)
+            offset += _EVENT_HEADER.size
+            name = buf[offset:offset + namelen].rstrip(b'\0')
+            offset += namelen
+            if mask & IN_Q_OVERFLOW:
+                dprint(2, "inotify queue overflow, will poll everything")
+                self._changed = None
+                continue
+            dirname = self._wd_path.get(wd)
+            if dirname is None:
+                continue
+            if self._changed is not None:
+                self._changed.add(dirname)
+                if name:
+                    self._changed.add(os.path.join(dirname, os.fsdecode(name)))
+            # watch was removed by the kernel (directory deleted or unmounted): forget about it,
+            # so that its watchers go back to being polled
+            if mask & IN_IGNORED:
+                dprintf(3, "inotify watch %d on %s removed\n", wd, dirname)
+                self._wd_path.pop(wd, None)
+                self._path_wd.pop(dirname, None)
+                self._refcount.pop(dirname, None)
+
+    def markChanged(self, path):
+        if self._changed is not None:
+            self._changed.add(path)
+
+    def changedPaths(self):
+        self.readEvents()
+        changed = self._changed
+        self._changed = set()
+        return changed
+
+    def close(self):
+        if self._fd is not None:
+            try:
+                os.close(self._fd)
+            except OSError:
+                pass
+            self._fd = None
+        self._wd_path = {}
+        self._path_wd = {}
+        self._refcount = {}
+
+
+def makeBackend(use_inotify=True):
+    """Returns the best available backend: InotifyBackend if enabled and supported, else PollingBackend."""
+    if use_inotify:
+        try:
+            return InotifyBackend()
+        except InotifyBackend.Unavailable as exc:
+            dprint(1, "inotify not available (%s), will poll for changes" % exc)
+    return PollingBackend()
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""Purr.WatchService lets all Purrers in a process share their watcher backend and directory scans.
+
+Each Purrer subscribes to the service, and gets back a Subscription object that it uses in place of its own
+watcher backend (see Purr.WatchBackend). The service holds a single backend (and so, with inotify, a single
+file descriptor and one watch per physical directory), and reference-counts directories across
+subscriptions. Changes reported by the backend are handed out to every subscription, since each Purrer
+needs to see them on its own next rescan. If the backend provides a file descriptor, the service (rather
+than each Purrer) listens on it, and emits a pathsChanged signal when events come in.
+
+Directories watched by more than one subscription also share their listings: when a watched directory
+has been modified, the first Purrer to notice reads it, and the others get the same listing (as long as
+the directory mtime is the same), so each physical directory is read once per change, however many logs
+are watching it.
+"""
+
+import os
+import threading
+
+from PyQt4.Qt import QObject, QSocketNotifier, SIGNAL
+
+import Purr.WatchBackend
+from Purr import dprint, dprintf
+
+
+class Subscription(object):
+    """A Purrer's view of the shared watch service. Implements the same interface as the backends in
+    Purr.WatchBackend."""
+
+    def __init__(self, service):
+        self._service = service
+        # dict of dirname: number of watch() calls on it that have not been unwatch()ed yet
+        self._refcount = {}
+        # set of paths changed since the last changedPaths() call, or None if everything needs to be polled
+        self._changed = set()
+
+    def watch(self, dirname):
+        self._refcount[dirname] = self._refcount.get(dirname, 0) + 1
+        return self._service._watch(self, dirname, self._refcount[dirname] == 1)
+
+    def unwatch(self, dirname):
+        count = self._refcount.get(dirname, 0)
+        if not count:
+            return
+        if count > 1:
+            self._refcount[dirname] = count - 1
+        else:
+            del self._refcount[dirname]
+        self._service._unwatch(self, dirname, count == 1)
+
+    def isWatching(self, dirname):
+        return dirname in self._refcount and self._service.isWatching(dirname)
+
+    def fileno(self):
+        # the service listens on the backend's file descriptor, and emits pathsChanged
+        return None
+
+    def readEvents(self):
+        self._service.readEvents()
+
+    def hasChanges(self):
+        """Returns True if there are changes waiting to be picked up by changedPaths()."""
+        with self._service._lock:
+            return self._changed is None or bool(self._changed)
+
+    def markChanged(self, path):
+        with self._service._lock:
+            if self._changed is not None:
+                self._changed.add(path)
+
+    def changedPaths(self):
+        self._service.readEvents()
+        with self._service._lock:
+            changed = self._changed
+            self._changed = set()
+        return changed
+
+    def close(self):
+        self._service._unsubscribe(self)
+
+
+class WatchService(QObject):
+    def __init__(self, use_inotify=True):
+        QObject.__init__(self)
+        self._use_inotify = use_inotify
+        self._lock = threading.RLock()
+        self._backend = None
+        self._notifier = None
+        self._subscriptions = []
+        # dict of dirname: number of subscriptions watching it
+        self._dir_subs = {}
+        # listings of directories watched by more than one subscription: dict of dirname: (mtime, names)
+        self._listings = {}
+
+    def subscribe(self):
+        """Returns a new Subscription to the service."""
+        with self._lock:
+            if self._backend is None:
+                self._backend = Purr.WatchBackend.makeBackend(self._use_inotify)
+                if self._backend.fileno() is not None:
+                    self._notifier = QSocketNotifier(self._backend.fileno(), QSocketNotifier.Read, self)
+                    self.connect(self._notifier, SIGNAL("activated(int)"), self._processBackendEvents)
+            sub = Subscription(self)
+            self._subscriptions.append(sub)
+            dprintf(2, "watch service: %d subscriptions\n", len(self._subscriptions))
+            return sub
+
+    def _unsubscribe(self, sub):
+        with self._lock:
+            if sub not in self._subscriptions:
+                return
+            for dirname, count in list(sub._refcount.items()):
+                for i in range(count):
+                    self._backend.unwatch(dirname)
+                self._releaseDir(dirname)
+            sub._refcount = {}
+            self._subscriptions.remove(sub)
+            # nobody left, so release the backend (and its file descriptor)
+            if not self._subscriptions:
+                dprint(2, "watch service: no subscriptions left, closing backend")
+                if self._notifier:
+                    self._notifier.setEnabled(False)
+                    self._notifier = None
+                self._backend.close()
+                self._backend = None
+                self._dir_subs = {}
+                self._listings = {}
+
+    def _watch(self, sub, dirname, first):
+        with self._lock:
+            if first:
+                self._dir_subs[dirname] = self._dir_subs.get(dirname, 0) + 1
+            # the backend refcounts its watches itself, so every watch() is passed on
+            return self._backend.watch(dirname)
+
+    def _unwatch(self, sub, dirname, last):
+        with self._lock:
+            self._backend.unwatch(dirname)
+            if last:
+                self._releaseDir(dirname)
+
+    def _releaseDir(self, dirname):
+        count = self._dir_subs.get(dirname, 0) - 1
+        if count > 0:
+            self._dir_subs[dirname] = count
+        else:
+            self._dir_subs.pop(dirname, None)
+        # a listing is only kept while it is being shared
+        if count < 2:
+            self._listings.pop(dirname, None)
+
+    def isWatching(self, dirname):
+        with self._lock:
+            return self._backend is not None and self._backend.isWatching(dirname)
+
+    def readEvents(self):
+        """Reads pending events from the backend, and hands them out to all subscriptions."""
+        with self._lock:
+            if self._backend is None:
+                return
+            changed = self._backend.changedPaths()
+            if changed is not None and not changed:
+                return
+            for sub in self._subscriptions:
+                if changed is None:
+                    sub._changed = None
+                elif sub._changed is not None:
+                    sub._changed.update(changed)
+
+    def _processBackendEvents(self, fd=None):
+        """Called when the backend has events pending. Reads them in, and lets the world know."""
+        self.readEvents()
+        self.emit(SIGNAL("pathsChanged"))
+
+    def listdir(self, dirname, mtime):
+        """Returns the names of the entries of directory 'dirname' (as a frozenset), whose mtime is 'mtime'.
+        If the directory is watched by more than one subscription, the listing is cached for as long as
+        the mtime stays the same, so the directory is only read once. Raises OSError on access errors."""
+        with self._lock:
+            cached = self._listings.get(dirname)
+            if cached is not None and cached[0] == mtime:
+                dprintf(4, "%s: using shared listing\n", dirname)
+                return cached[1]
+        # mtime was taken before the directory is read here, so the cached listing is never older than its mtime
+        names = frozenset(os.listdir(dirname))
+        with self._lock:
+            if self._dir_subs.get(dirname, 0) > 1:
+                self._listings[dirname] = mtime, names
+        return names
+
+    def report(self):
+        """Returns dict describing the state of the service."""
+        with self._lock:
+            return dict(subscriptions=len(self._subscriptions), dirs=len(self._dir_subs),
+                        shared_dirs=len([count for count in self._dir_subs.values() if count > 1]),
+                        cached_listings=len(self._listings))
+
+
+# the process-wide service, created on first use
+_service = None
+_service_lock = threading.Lock()
+
+
+def getService(use_inotify=True):
+    """Returns the process-wide WatchService. 'use_inotify' only has an effect when the service is created."""
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = WatchService(use_inotify)
+        return _service
+
+
+def listdir(dirname, mtime):
+    """Lists a directory, using the shared listings of the process-wide service if there is one."""
+    if _service is None:
+        return frozenset(os.listdir(dirname))
+    return _service.listdir(dirname, mtime)
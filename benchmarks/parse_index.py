@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Compares the fast path of Purr's index parser against the full HTMLParser.
+
+Takes one or more purrlog directories as the corpus. Every entry's index.html (and the log's own
+index.html) is parsed both ways, the results are checked for equality, and timings are reported.
+
+Usage: parse_index.py PURRLOG [PURRLOG ...]
+"""
+
+import glob
+import os.path
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from Purr.Parsers import LogIndexParser, LogEntryIndexParser
+
+
+def parse_full(parser, filename):
+    for line in open(filename):
+        parser.feed(line)
+    return parser
+
+
+def parse_fast(parser, filename):
+    parser.parseFile(filename)
+    return parser
+
+
+def result(parser):
+    """Returns the parser's findings as a comparable tuple."""
+    dps = [(dp.filename, dp.sourcepath, dp.policy, dp.quiet, dp.timestamp, dp.render, dp.comment, dp.archive,
+            dp.hash)
+           for dp in getattr(parser, 'dps', [])]
+    return parser.title, parser.timestamp, getattr(parser, 'comments', None), dps
+
+
+def run(files, method):
+    results = []
+    t0 = time.time()
+    for parser_class, filename in files:
+        if parser_class is LogEntryIndexParser:
+            parser = parser_class(os.path.dirname(filename))
+        else:
+            parser = parser_class()
+        results.append(result(method(parser, filename)))
+    return time.time() - t0, results
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    files = []
+    for logdir in sys.argv[1:]:
+        if os.path.exists(os.path.join(logdir, "index.html")):
+            files.append((LogIndexParser, os.path.join(logdir, "index.html")))
+        for filename in sorted(glob.glob(os.path.join(logdir, "*-*-*", "index.html"))):
+            files.append((LogEntryIndexParser, filename))
+    nbytes = sum([os.path.getsize(filename) for cls, filename in files])
+    print("%d index files, %.1f MB" % (len(files), nbytes / 1e6))
+    t_full, res_full = run(files, parse_full)
+    t_fast, res_fast = run(files, parse_fast)
+    mismatches = [filename for (cls, filename), a, b in zip(files, res_full, res_fast) if a != b]
+    print("  full parser: %.3fs" % t_full)
+    print("  fast path:   %.3fs (%.1fx)" % (t_fast, t_full / (t_fast or 1e-9)))
+    for filename in mismatches:
+        print("  results differ for %s" % filename)
+    sys.exit(1 if mismatches else 0)
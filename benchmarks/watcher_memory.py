@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Measures the per-watcher memory overhead of Purrer.WatchedFile.
+
+Creates N watchers for (non-existent) files, and reports the memory allocated per watcher, as seen by
+tracemalloc. For comparison, the same is done for a subclass that has a per-instance __dict__, which is
+what watchers looked like before they were given __slots__ (the old per-watcher QObject is not counted
+here, so the real savings are larger than reported).
+
+Usage: watcher_memory.py [N]
+"""
+
+import os.path
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from Purr.Purrer import Purrer
+
+
+class DictWatchedFile(Purrer.WatchedFile):
+    """WatchedFile with a per-instance __dict__, for comparison."""
+    pass
+
+
+def measure(watcher_class, num):
+    """Returns (bytes per watcher, seconds per watcher) for creating 'num' watchers of the given class."""
+    paths = ["/data/run%03d/image%06d.fits" % (i % 100, i) for i in range(num)]
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    t0 = time.time()
+    watchers = [watcher_class(path, mtime=1) for path in paths]
+    elapsed = time.time() - t0
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    del watchers
+    return used / float(num), elapsed / num
+
+
+if __name__ == "__main__":
+    num = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print("%d watchers:" % num)
+    for label, watcher_class in ("with __dict__", DictWatchedFile), ("with __slots__", Purrer.WatchedFile):
+        size, elapsed = measure(watcher_class, num)
+        print("  %-16s %6.0f bytes/watcher, %5.2f us/watcher" % (label, size, elapsed * 1e6))